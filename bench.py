@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks for the ring data path, run against the emulated device so they
+work on any Linux box.
+
+	python3 bench.py -o before.json
+	python3 bench.py -o after.json
+	python3 bench.py --compare before.json after.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import socket
+import struct
+import sys
+import threading
+import time
+
+from btdrv import *
+from emu import EmuDevice
+from util import percentile
+
+
+class QuietDriver(BTDriver):
+	def log(self, *args):
+		pass
+
+
+def make_driver(name='bench', **kw):
+	cfg = ControllerConfig(name=name, firmware=None, ptb=None, calibration=None, vhci=None, **kw)
+	drv = QuietDriver(EmuDevice(name), cfg)
+	drv.bring_up()
+	return drv
+
+
+def summarize(samples, batch=1):
+	"""samples are ns per batch of `batch` operations"""
+	per_op = [sample / batch for sample in samples]
+	total = sum(samples)
+	return {
+		'iters': len(samples) * batch,
+		'ops_per_sec': len(samples) * batch / (total / 1e9) if total else 0,
+		'p50_ns': percentile(per_op, 50),
+		'p99_ns': percentile(per_op, 99),
+	}
+
+
+def bench_loop(fn, iters, batch=1):
+	now = time.perf_counter_ns
+	samples = []
+	for _ in range(iters // batch):
+		t0 = now()
+		for _ in range(batch):
+			fn()
+		samples.append(now() - t0)
+	return summarize(samples, batch)
+
+
+def wait_consumed(drv, pipe):
+	while drv.get_tr_tail(pipe) != drv.get_tr_head(pipe):
+		os.sched_yield()
+
+
+def bench_send_transfer(drv, pipe, data, iters):
+	"""Time send_transfer itself, letting the firmware catch up between bursts"""
+	now = time.perf_counter_ns
+	samples = []
+	burst = 32
+	for i in range(iters):
+		t0 = now()
+		drv.send_transfer(pipe, data, False)
+		samples.append(now() - t0)
+		if i % burst == burst - 1:
+			wait_consumed(drv, pipe)
+	wait_consumed(drv, pipe)
+	return summarize(samples)
+
+
+def bench_completions(iters):
+	"""Parse completions straight out of CR1 with the firmware stopped"""
+	drv = make_driver('bench-cr')
+	time.sleep(0.05)
+	drv.irq_do_main_stuff = False
+	drv.hw.close()
+	time.sleep(0.05)
+
+	cr_buf, cr_ring_sz, cr_ent_sz = drv.completion_ring_infos[1]
+	batch = 64
+	now = time.perf_counter_ns
+	samples = []
+	for i in range(iters // batch):
+		tail = drv.get_cr_tail(1)
+		for j in range(batch):
+			idx = (tail + j) % cr_ring_sz
+			struct.pack_into(COMPLETIONHEADER_STR, cr_buf.mem, idx*cr_ent_sz, 0, b'\x04', 5, j, 0, b'\x00'*6)
+		drv.set_cr_head(1, (tail + batch) % cr_ring_sz)
+		t0 = now()
+		drv.process_completions()
+		samples.append(now() - t0)
+	drv.close()
+	return summarize(samples, batch)
+
+
+def bench_vhci(drv, pkt, iters):
+	ours, theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+	drv.vhci_fd = theirs.fileno()
+	thread = threading.Thread(target=drv.run_vhci, daemon=True)
+	thread.start()
+
+	now = time.perf_counter_ns
+	samples = []
+	for _ in range(iters):
+		t0 = now()
+		ours.send(pkt)
+		ours.recv(4096)
+		samples.append(now() - t0)
+
+	drv.vhci_fd = None
+	theirs.shutdown(socket.SHUT_RDWR)
+	thread.join()
+	ours.close()
+	theirs.close()
+	return summarize(samples)
+
+
+def run_all(scale):
+	results = {}
+	def record(name, result):
+		results[name] = result
+		print(f"{name:32} {result['ops_per_sec']:12.0f} ops/s  p50 {result['p50_ns']/1000:9.2f} us  p99 {result['p99_ns']/1000:9.2f} us")
+
+	n = lambda count: max(1, int(count * scale))
+
+	drv = make_driver()
+	record('send_transfer/pipe0-sync', bench_loop(lambda: drv.send_transfer(0, bytes(0x34)), n(500)))
+	record('send_transfer/pipe1-footer', bench_send_transfer(drv, 1, b'\x03\x0c\x00', n(2000)))
+	record('send_transfer/pipe3-footer', bench_send_transfer(drv, 3, bytes(60), n(2000)))
+	record('send_transfer/pipe5-footer', bench_send_transfer(drv, 5, bytes(100), n(2000)))
+	record('send_transfer/pipe5-iobuf', bench_send_transfer(drv, 5, bytes(1020), n(2000)))
+
+	record('accessors/get_tr_head', bench_loop(lambda: drv.get_tr_head(5), n(100000), 100))
+	record('accessors/set_tr_head', bench_loop(lambda: drv.set_tr_head(8, 0), n(100000), 100))
+	record('accessors/get_cr_head', bench_loop(lambda: drv.get_cr_head(1), n(100000), 100))
+	record('accessors/set_cr_tail', bench_loop(lambda: drv.set_cr_tail(5, drv.get_cr_tail(5)), n(100000), 100))
+
+	hdr = TransferHeader(flags=2, len_=100, unk_0x3_=b'\x00', buf_iova=0, msg_id=1, unk_0xe_=b'\x00\x00')
+	record('headers/pack-transfer', bench_loop(lambda: struct.pack(TRANSFERHEADER_STR, *hdr), n(100000), 100))
+	chdr = struct.pack(COMPLETIONHEADER_STR, 2, b'\x04', 2, 1, 6, b'\x00'*6)
+	record('headers/unpack-completion', bench_loop(lambda: CompletionHeader._make(struct.unpack(COMPLETIONHEADER_STR, chdr)), n(100000), 100))
+
+	cal_blob = os.urandom(0x1000)
+	ptb_blob = os.urandom(0x8000)
+	record('chunking/calibration-4k', bench_loop(lambda: list(calibration_commands(cal_blob)), n(2000)))
+	record('chunking/ptb-32k', bench_loop(lambda: list(ptb_commands(ptb_blob)), n(500)))
+
+	pkt = os.urandom(251)
+	record('hexdump/chexdump-251', bench_loop(lambda: chexdump(pkt, print_fn=lambda line: None), n(2000)))
+
+	record('vhci/hci-cmd-roundtrip', bench_vhci(drv, b'\x01\x03\x0c\x00', n(2000)))
+	record('vhci/acl-footer-roundtrip', bench_vhci(drv, b'\x02' + bytes(100), n(2000)))
+	record('vhci/acl-iobuf-roundtrip', bench_vhci(drv, b'\x02' + bytes(1020), n(2000)))
+	record('vhci/sco-roundtrip', bench_vhci(drv, b'\x03' + bytes(60), n(2000)))
+	drv.close()
+
+	record('completions/parse', bench_completions(n(20000)))
+	return results
+
+
+def compare(old_path, new_path, threshold, p99_threshold):
+	with open(old_path) as f:
+		old = json.load(f)['results']
+	with open(new_path) as f:
+		new = json.load(f)['results']
+
+	regressions = 0
+	for name in sorted(set(old) | set(new)):
+		if name not in old or name not in new:
+			print(f"{name:32} only in {'new' if name in new else 'old'}")
+			continue
+		a, b = old[name], new[name]
+		ops = (b['ops_per_sec'] / a['ops_per_sec'] - 1) * 100 if a['ops_per_sec'] else 0
+		p50 = (b['p50_ns'] / a['p50_ns'] - 1) * 100 if a['p50_ns'] else 0
+		p99 = (b['p99_ns'] / a['p99_ns'] - 1) * 100 if a['p99_ns'] else 0
+		flag = ''
+		if ops < -threshold or p50 > threshold or p99 > p99_threshold:
+			flag = '  REGRESSION'
+			regressions += 1
+		print(f"{name:32} ops/s {ops:+7.1f}%  p50 {p50:+7.1f}%  p99 {p99:+7.1f}%{flag}")
+	return regressions
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('-o', '--output', help="write results as JSON")
+	parser.add_argument('--scale', type=float, default=1.0, help="multiply iteration counts")
+	parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'), help="compare two result files instead of running")
+	parser.add_argument('--threshold', type=float, default=10.0, help="percent drop in ops/s or rise in p50 counted as a regression (default 10)")
+	parser.add_argument('--p99-threshold', type=float, default=50.0, help="percent rise in p99 counted as a regression (default 50)")
+	args = parser.parse_args()
+
+	if args.compare:
+		regressions = compare(*args.compare, args.threshold, args.p99_threshold)
+		print(f"{regressions} regressions")
+		sys.exit(1 if regressions else 0)
+
+	results = run_all(args.scale)
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({
+				'meta': {
+					'time': time.time(),
+					'python': platform.python_version(),
+					'machine': platform.machine(),
+					'cpus': os.cpu_count(),
+				},
+				'results': results,
+			}, f, indent=1)
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,1291 @@
+from collections import namedtuple
+import itertools
+import os
+import struct
+import threading
+import time
+
+from bttrace import *
+from dma import *
+from fwlog import FirmwareLog
+from idle import IdleManager
+from submitq import DeviceTimeout, PipeWorker, RingReset
+from watchdog import Watchdog
+from util import *
+
+
+# dunno how much we need or anything
+# dunno if dart limit is lower limit of iova or size limit
+IOVA_START = 0x2000000
+SHARED_MEM_SZ = 0x2000000
+
+DEFAULT_FIRMWARE = 'BCM4387C2_19.3.395.4044_PCIE_macOS_MaldivesES2_CLPC_3ANT_OS_USI_20211013.bin'
+DEFAULT_PTB = 'BCM4387C2_DVT_Finalv1_PCIE_macOS_MaldivesES2_CLPC_3ANT_OS_USI_K_R_20210723.ptb'
+DEFAULT_CALIBRATION = 'bluetooth-taurus-calibration-bf.bin'
+
+ControllerConfig = namedtuple('ControllerConfig', [
+	'name',
+	'bdf',
+	'group',
+	'firmware',
+	'ptb',
+	'calibration',
+	'iova_start',
+	'shared_mem_sz',
+	# None = don't forward to VHCI
+	'vhci',
+	# let the firmware complete transfers in any order
+	'ooo_completions',
+	# 'anon', 'hugetlb' (MAP_HUGETLB) or a hugetlbfs mount point
+	'dma_backing',
+	# MAP_POPULATE the DMA regions up front
+	'dma_prefault',
+	'dma_mlock',
+	# file to dump the trace buffer to, None = no tracing
+	'trace',
+	# write the firmware debug pipe to this (rotating) file, None = don't open it
+	'debug_log',
+	'debug_log_max_bytes',
+	'debug_log_backups',
+	# hexdump 1 in every packet_dump VHCI packets (None = off), at most packet_dump_bytes of each
+	'packet_dump',
+	'packet_dump_bytes',
+	# quiesce the device after this many seconds without ring activity, None = never
+	'idle_timeout',
+	# pipe -> TX footer size in dwords, overrides TX_FOOTER_SIZES
+	'footer_sizes',
+	# give up on the device after this many seconds waiting for an interrupt/completion
+	'wait_timeout',
+	# reset the device if a TX pipe makes no progress for this many seconds, None = don't watch
+	'stall_timeout',
+	# give each pipe its own thread that owns the ring, fed through a lock-free queue
+	'submit_workers',
+	# CPUs to pin those threads to, handed out round robin
+	'submit_cpus',
+], defaults=[
+	None,
+	None,
+	DEFAULT_FIRMWARE,
+	DEFAULT_PTB,
+	DEFAULT_CALIBRATION,
+	IOVA_START,
+	SHARED_MEM_SZ,
+	'/dev/vhci',
+	False,
+	'anon',
+	False,
+	False,
+	None,
+	None,
+	0x100000,
+	3,
+	None,
+	64,
+	None,
+	None,
+	5.0,
+	None,
+	False,
+	None,
+])
+
+
+# registers are (bar, offset), the backend knows where the bars actually are
+REG_0 = (1, 0x20044c)
+RTI_GET_CAPABILITY = (1, 0x200450)
+BOOTSTAGE = (1, 0x200454)
+BAR1_IMG_ADDR_LO = (1, 0x200478)
+BAR1_IMG_ADDR_HI = (1, 0x20047c)
+BAR1_IMG_SZ = (1, 0x200480)
+BTI_EXIT_CODE_RTI_IMG_RESPONSE = (1, 0x200488)
+REG_7 = (1, 0x200464)
+RTI_GET_STATUS = (1, 0x20045c)
+RTI_CONTEXT_LO = (1, 0x20048c)
+RTI_CONTEXT_HI = (1, 0x200490)
+RTI_WINDOW_LO = (1, 0x200494)
+RTI_WINDOW_HI = (1, 0x200498)
+RTI_WINDOW_SZ = (1, 0x20049c)
+REG_14 = (1, 0x20054c)
+IMG_DOORBELL = (0, 0x140)
+RTI_CONTROL = (0, 0x144)
+RTI_SLEEP_CONTROL = (0, 0x150)
+CHIPCOMMON_CHIP_STATUS = (0, 0x302c)
+DOORBELL_STATUS = (0, 0x6620)
+DOORBELL_05 = (0, 0x174)
+DOORBELL_6 = (0, 0x154)
+REG_21 = (0, 0x610)
+BTI_MSI_LO = (0, 0x580)
+BTI_MSI_HI = (0, 0x584)
+REG_24 = (0, 0x588)
+HOST_WINDOW_LO = (0, 0x590)
+HOST_WINDOW_HI = (0, 0x594)
+HOST_WINDOW_SZ = (0, 0x598)
+RTI_IMG_LO = (0, 0x5a0)
+RTI_IMG_HI = (0, 0x5a4)
+RTI_IMG_SZ = (0, 0x5a8)
+AXI2AHB_ERROR_STATUS = (0, 0x1908)
+RTI_MSI_LO = (1, 0x2004f8)
+RTI_MSI_HI = (1, 0x2004fc)
+RTI_MSI_DATA = (1, 0x200500)
+APBBRIDGECB0_ERROR_STATUS = (0, 0x5908)
+APBBRIDGECB0_ERROR_LO = (0, 0x590c)
+APBBRIDGECB0_ERROR_HI = (0, 0x5910)
+APBBRIDGECB0_ERROR_MASTER_ID = (0, 0x5914)
+
+
+TransferHeader = namedtuple('TransferHeader', [
+	'flags',
+	# bit0 = has payload in buf_iova?
+	# bit1 = has payload in footer
+	'len_',
+	# XXX can length be 3 bytes?
+	'unk_0x3_',
+	'buf_iova',
+	'msg_id',
+	# XXX macos driver takes special effort to munge byte 0xf
+	'unk_0xe_',
+])
+TRANSFERHEADER_STR = "<BH1sQH2s"
+TRANSFERHEADER_SZ = 0x10
+
+CompletionHeader = namedtuple('CompletionHeader', [
+	'flags',
+	# bit1 = has payload in footer
+	'unk_0x1',
+	# normally unk is 4
+	'pipe_idx',
+	'msg_id',
+	'len_',
+	'pad_0xa_',
+])
+COMPLETIONHEADER_STR = "<B1sHHI6s"
+COMPLETIONHEADER_SZ = 0x10
+
+
+ContextStruct = namedtuple('ContextStruct', [
+    'version',
+    'sz',
+    'enabled_caps',
+    'perInfo',
+    'crHIA',
+    'trTIA',
+    'crTIA',
+    'trHIA',
+    'crIAEntry',
+    'trIAEntry',
+    'mcr',
+    'mtr',
+    'mtrEntry',
+    'mcrEntry',
+    'mtrDb',
+    'mcrDb',
+    'mtrMsi',
+    'mcrMsi',
+    'mtrOptHeadSize',
+    'mtrOptFootSize',
+    'mcrOptHeadSize',
+    'mcrOptFootSize',
+    'res_inPlaceComp_oOOComp',
+    'piMsi',
+    'scratchPa',
+    'scratchSize',
+    'res',
+])
+CONTEXTSTRUCT_STR = "<HHIQQQQQHHQQHHHHHHBBBBHHQII"
+CONTEXTSTRUCT_SZ = 0x68
+
+# res_inPlaceComp_oOOComp
+# XXX bit order is a guess from the field name
+CTX_OOO_COMP = 1
+CTX_IN_PLACE_COMP = 2
+
+PER_INFO_SZ = 0x10
+
+
+OpenCompletionRingMessage = namedtuple('OpenCompletionRingMessage', [
+    'msg_type',
+    'head_size',
+    'foot_size',
+    'pad_0x3_',
+    'cr_idx',
+    'cr_idx_',
+    'ring_iova',
+    'ring_count',
+    'unk_0x12_',
+    'pad_0x16_',
+    'msi',
+    'intmod_delay',
+    'intmod_bytes',
+    'accum_delay',
+    'accum_bytes',
+    'pad_0x2a_',
+])
+OPENCOMPLETIONRING_STR = "<BBB1sHHQHI6sHHIHI10s"
+
+OpenPipeMessage = namedtuple('OpenPipeMessage', [
+    'msg_type',
+    'head_size',
+    'foot_size',
+    'pad_0x3_',
+    'pipe_idx',
+    'pipe_idx_',
+    'ring_iova',
+    'pad_0x10_',
+    'ring_count',
+    'completion_ring_index',
+    'doorbell_idx',
+    'flags',
+    # bit3 = oc
+    # bit4 = reliable
+    # bit7 = virtual (no ring_iova)
+    # bit8 = sync
+    'pad_0x20_',
+])
+OPENPIPE_STR = "<BBB1sHHQ8sHHHH20s"
+
+
+NUM_TRANSFER_RINGS = 9
+# the last one is only opened for the debug pipe
+NUM_COMPLETION_RINGS = 7
+DEBUG_CR = 6
+
+# all the head/tail index arrays live in one buffer
+transfer_rings_heads_off = 0
+transfer_rings_tails_off = transfer_rings_heads_off + NUM_TRANSFER_RINGS*2
+completion_rings_heads_off = transfer_rings_tails_off + NUM_TRANSFER_RINGS*2
+completion_rings_tails_off = completion_rings_heads_off + NUM_COMPLETION_RINGS*2
+RING_IDX_SZ = completion_rings_tails_off + NUM_COMPLETION_RINGS*2
+
+# receive buffers kept posted on pipe 6
+ACL_RX_BUFS = 8
+ACL_RX_BUF_SZ = 0x1000
+# and on pipe 8
+DEBUG_RX_BUFS = 16
+DEBUG_RX_BUF_SZ = 0x1000
+
+# RTI_SLEEP_CONTROL values, XXX from the Linux hci_bcm4377 driver, which only
+# uses them for system suspend
+SLEEP_CONTROL_UNQUIESCE = 0
+SLEEP_CONTROL_AWAKE = 2
+SLEEP_CONTROL_QUIESCE = 3
+
+# inline footer size in dwords for the pipes we send on. Anything that
+# doesn't fit goes in a separate DMA buffer.
+TX_FOOTER_SIZES = {
+	1: 66,	# HCI
+	3: 66,	# SCO
+	5: 252,	# ACL
+}
+
+# pipes we post empty buffers on for the firmware to fill
+RX_PIPES = (6, 8)
+
+def pipe2db(pipe):
+	if pipe == 0:	# control
+		return 0
+	elif pipe == 1:	# HCI
+		return 1
+	elif pipe == 2:	# HCI
+		return 2
+	elif pipe == 3:	# SCO
+		return 6	# XXX special
+	elif pipe == 4:	# SCO
+		return 6	# XXX special
+	elif pipe == 5:	# ACL
+		return 3
+	elif pipe == 6: # ACL
+		return 4
+	elif pipe == 8:	# debug
+		return 5
+	else:
+		assert False
+
+
+# register snapshot taken when the device stops responding
+ERROR_REGS = [
+	('AXI2AHB_ERROR_STATUS', AXI2AHB_ERROR_STATUS),
+	('APBBRIDGECB0_ERROR_STATUS', APBBRIDGECB0_ERROR_STATUS),
+	('APBBRIDGECB0_ERROR_LO', APBBRIDGECB0_ERROR_LO),
+	('APBBRIDGECB0_ERROR_HI', APBBRIDGECB0_ERROR_HI),
+	('APBBRIDGECB0_ERROR_MASTER_ID', APBBRIDGECB0_ERROR_MASTER_ID),
+	('BOOTSTAGE', BOOTSTAGE),
+	('RTI_GET_STATUS', RTI_GET_STATUS),
+	('CHIPCOMMON_CHIP_STATUS', CHIPCOMMON_CHIP_STATUS),
+]
+
+
+class CompletionSlot:
+	__slots__ = ('armed', 'evt', 'hdr', 'payload')
+
+	def __init__(self):
+		self.armed = False
+		self.evt = threading.Event()
+		self.hdr = None
+		self.payload = None
+
+	def arm(self):
+		self.hdr = None
+		self.payload = None
+		self.evt.clear()
+		self.armed = True
+
+	def fire(self, hdr, payload):
+		self.hdr = hdr
+		self.payload = payload
+		self.armed = False
+		self.evt.set()
+
+	def wait(self, timeout=None):
+		return self.evt.wait(timeout)
+
+
+class CompletionTable:
+	"""
+	Tracks outstanding transfers by (pipe, msg_id) instead of by ring position,
+	so completions can come back in any order. Every slot is allocated up front
+	and reused each time the msg_id wraps around.
+
+	Virtual pipes don't have msg_ids we control, so each pipe also has a slot
+	for "the next completion on this pipe, whatever it is".
+	"""
+
+	def __init__(self, num_pipes=NUM_TRANSFER_RINGS, ring_sz=128):
+		self.ring_sz = ring_sz
+		self.slots = [[CompletionSlot() for _ in range(ring_sz)] for _ in range(num_pipes)]
+		self.next_slots = [CompletionSlot() for _ in range(num_pipes)]
+
+	def arm(self, pipe, msg_id):
+		slot = self.slots[pipe][msg_id]
+		assert not slot.armed
+		slot.arm()
+		return slot
+
+	def arm_next(self, pipe):
+		slot = self.next_slots[pipe]
+		assert not slot.armed
+		slot.arm()
+		return slot
+
+	def complete(self, hdr, payload):
+		slot = self.next_slots[hdr.pipe_idx]
+		if slot.armed:
+			slot.fire(hdr, payload)
+		if hdr.msg_id < self.ring_sz:
+			slot = self.slots[hdr.pipe_idx][hdr.msg_id]
+			if slot.armed:
+				slot.fire(hdr, payload)
+
+
+def make_openpipe(pipe_idx, foot_size, ring_iova, completion_ring_index, flags):
+	return OpenPipeMessage(
+		msg_type=1,
+		head_size=0,
+		foot_size=foot_size,
+		pad_0x3_=b'\x00',
+		pipe_idx=pipe_idx,
+		pipe_idx_=pipe_idx,
+		ring_iova=ring_iova,
+		pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
+		ring_count=128,
+		completion_ring_index=completion_ring_index,
+		doorbell_idx=pipe2db(pipe_idx),
+		flags=flags,
+		pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
+
+
+def read_blob(path):
+	if path is None:
+		return b''
+	with open(path, 'rb') as f:
+		return f.read()
+
+
+class BTDriver:
+	"""One instance per controller, talks to either a VfioDevice or an EmuDevice"""
+
+	def __init__(self, hw, cfg):
+		self.hw = hw
+		self.cfg = cfg
+		self.iova_start = cfg.iova_start
+		self.shared_mem_sz = cfg.shared_mem_sz
+
+		self.py_irq_evt = threading.Event()
+		self.irq_do_main_stuff = False
+		self.irq_do_magic = False
+		self.completions = CompletionTable()
+		self.msg_ids = {}
+
+		# idx -> (DmaBuf, count, entry size)
+		self.completion_ring_infos = {}
+		self.transfer_ring_infos = {}
+		# pipe -> msg_id -> DmaBuf, freed/reposted when the completion comes in
+		self.tx_inflight = [{} for _ in range(NUM_TRANSFER_RINGS)]
+		self.rx_posted = [{} for _ in range(NUM_TRANSFER_RINGS)]
+		# per pipe TX placement counts, and the biggest packet that didn't fit
+		self.tx_inline = [0] * NUM_TRANSFER_RINGS
+		self.tx_indirect = [0] * NUM_TRANSFER_RINGS
+		self.tx_indirect_max = [0] * NUM_TRANSFER_RINGS
+		self.tx_tags = [f'pipe{pipe} tx' for pipe in range(NUM_TRANSFER_RINGS)]
+
+		self.footer_sizes = dict(TX_FOOTER_SIZES)
+		if cfg.footer_sizes:
+			self.footer_sizes.update({int(pipe): size for pipe, size in cfg.footer_sizes.items()})
+
+		self.arena = None
+		# every ring allocated since the last reset, whether it got opened or not
+		self.ring_bufs = []
+		self.ctx_buf = None
+		self.per_info = None
+		self.ring_idx_buf = None
+		self.ring_idx = None
+		self.vhci_fd = None
+		self.running = True
+
+		self.fwlog = None
+		self.idle = None
+		self.watchdog = None
+		self.fw_buf = None
+
+		# serializes VHCI sends against recovery, and completion processing against it
+		self.tx_gate = threading.Lock()
+		self.irq_lock = threading.Lock()
+		# recovered is clear from a timeout until a recovery succeeds, the
+		# reason sticks around for the watchdog to retry on
+		self.recovering = False
+		self.recovered = threading.Event()
+		self.recovered.set()
+		self.needs_recovery = None
+		self.recoveries = 0
+		# packets to send again once the rings are back, kept across failed recoveries
+		self.resend = []
+
+		# pipe -> PipeWorker, None = send from the calling thread
+		self.workers = [None] * NUM_TRANSFER_RINGS
+		self.num_crs = NUM_COMPLETION_RINGS if cfg.debug_log is not None else DEBUG_CR
+
+		if cfg.trace is not None:
+			self.tracebuf = TraceBuffer(cfg.name or '')
+			self.tr = self.tracebuf.emit
+		else:
+			self.tracebuf = None
+			self.tr = None
+
+		if cfg.packet_dump:
+			self.pktdump = DumpSampler(cfg.packet_dump, cfg.packet_dump_bytes, self.log)
+		else:
+			self.pktdump = None
+
+	def log(self, *args):
+		print(f"[{self.cfg.name}]", *args)
+
+	def mmioread32(self, reg):
+		return self.hw.mmioread32(reg)
+
+	def mmiowrite32(self, reg, val):
+		self.hw.mmiowrite32(reg, val)
+
+	def barrier(self):
+		self.hw.barrier()
+
+	def dump_dbs(self):
+		for i in range(7):
+			self.log(f"DB{i} val {self.mmioread32((DOORBELL_STATUS[0], DOORBELL_STATUS[1]+i*4))}")
+
+	def dump_trs(self):
+		for i in range(NUM_TRANSFER_RINGS):
+			self.log(f"TR{i} head {self.get_tr_head(i)} tail {self.get_tr_tail(i)}")
+
+	def dump_crs(self):
+		for i in range(NUM_COMPLETION_RINGS):
+			self.log(f"CR{i} head {self.get_cr_head(i)} tail {self.get_cr_tail(i)}")
+
+	def get_tr_head(self, idx):
+		return struct.unpack_from("<H", self.ring_idx, transfer_rings_heads_off+idx*2)[0]
+	def get_tr_tail(self, idx):
+		return struct.unpack_from("<H", self.ring_idx, transfer_rings_tails_off+idx*2)[0]
+	def get_cr_head(self, idx):
+		return struct.unpack_from("<H", self.ring_idx, completion_rings_heads_off+idx*2)[0]
+	def get_cr_tail(self, idx):
+		return struct.unpack_from("<H", self.ring_idx, completion_rings_tails_off+idx*2)[0]
+
+	def set_tr_head(self, idx, val):
+		# self.log(f"TR{idx} head -> {val}")
+		struct.pack_into("<H", self.ring_idx, transfer_rings_heads_off+idx*2, val)
+	def set_tr_tail(self, idx, val):
+		# self.log(f"TR{idx} tail -> {val}")
+		struct.pack_into("<H", self.ring_idx, transfer_rings_tails_off+idx*2, val)
+	def set_cr_head(self, idx, val):
+		# self.log(f"CR{idx} head -> {val}")
+		struct.pack_into("<H", self.ring_idx, completion_rings_heads_off+idx*2, val)
+	def set_cr_tail(self, idx, val):
+		# self.log(f"CR{idx} tail -> {val}")
+		struct.pack_into("<H", self.ring_idx, completion_rings_tails_off+idx*2, val)
+
+	def interrupt_handler(self):
+		while self.running:
+			events = struct.unpack("<Q", os.read(self.hw.irqfd, 8))[0]
+			if self.tr: self.tr(TR_IRQ, 0, 0, events)
+			self.py_irq_evt.set()
+			if self.idle: self.idle.interrupt()
+
+			if self.irq_do_main_stuff:
+				# self.log("dump per info")
+				# chexdump(self.per_info.mem)
+
+				# self.dump_trs()
+				# self.dump_crs()
+
+				with self.irq_lock:
+					if self.irq_do_main_stuff:
+						try:
+							self.process_completions()
+						except (RingReset, DeviceTimeout):
+							# the rings are being reset, or will be
+							pass
+
+	def process_completions(self):
+		for cr_idx in range(NUM_COMPLETION_RINGS):
+			if cr_idx not in self.completion_ring_infos:
+				continue
+			cr_head = self.get_cr_head(cr_idx)
+			if self.tr: self.tr(TR_CR_HEAD, cr_idx, 0, cr_head)
+			cr_tail = self.get_cr_tail(cr_idx)
+			cr_buf, cr_ring_sz, cr_ent_sz = self.completion_ring_infos[cr_idx]
+			cr_mem = cr_buf.mem
+
+			if cr_head >= cr_tail:
+				range_ = range(cr_tail, cr_head)
+			else:
+				range_ = itertools.chain(range(cr_tail, cr_ring_sz), range(0, cr_head))
+
+			for cr_ent_idx in range_:
+				cr_ent_off = cr_ent_idx*cr_ent_sz
+				# self.log(f"Data on CR{cr_idx}")
+				# chexdump(cr_mem[cr_ent_off:cr_ent_off+cr_ent_sz])
+				hdr = CompletionHeader._make(struct.unpack_from(COMPLETIONHEADER_STR, cr_mem, cr_ent_off))
+				# self.log(hdr)
+				payload = b''
+				if hdr.flags & 2:
+					payload = bytes(cr_mem[cr_ent_off+COMPLETIONHEADER_SZ:cr_ent_off+COMPLETIONHEADER_SZ+hdr.len_])
+					# chexdump(payload)
+
+				rx_buf = self.rx_posted[hdr.pipe_idx].pop(hdr.msg_id, None)
+				if rx_buf is not None and hdr.flags & 1:
+					payload = bytes(rx_buf.mem[:hdr.len_])
+					# chexdump(payload)
+
+				tx_buf = self.tx_inflight[hdr.pipe_idx].pop(hdr.msg_id, None)
+				if tx_buf is not None:
+					self.arena.free(tx_buf)
+
+				if self.tr: self.tr(TR_COMPLETION, hdr.pipe_idx, hdr.msg_id, hdr.len_)
+				self.completions.complete(hdr, payload)
+
+				self.set_cr_tail(cr_idx, (cr_ent_idx + 1) % cr_ring_sz)
+
+				self.barrier()
+				if hdr.pipe_idx == 8 and rx_buf is not None:
+					# firmware log
+					self.queue_transfer(hdr.pipe_idx, rx_buf)
+					self.fwlog.push(payload)
+				elif self.irq_do_magic:
+					if hdr.pipe_idx == 2:
+						# HCI in
+						# self.log("HCI in")
+						self.queue_boop(hdr.pipe_idx)
+						self.to_vhci(hdr.pipe_idx, b'\x04', payload)
+					elif hdr.pipe_idx == 6:
+						# ACL in
+						# self.log("ACL in")
+						self.queue_transfer(hdr.pipe_idx, rx_buf)
+						self.to_vhci(hdr.pipe_idx, b'\x02', payload)
+					elif hdr.pipe_idx == 4:
+						# SCO in
+						# self.log("SCO in")
+						# FIXME: are we poking this too many times?
+						self.queue_boop(hdr.pipe_idx)
+						self.to_vhci(hdr.pipe_idx, b'\x03', payload)
+
+	def to_vhci(self, pipe, pkt_type, payload):
+		if self.pktdump: self.pktdump(payload, f"pipe {pipe} in")
+		if self.vhci_fd is not None:
+			os.write(self.vhci_fd, pkt_type + payload)
+			if self.tr: self.tr(TR_VHCI_WRITE, pipe, 0, len(payload))
+
+	def ring_doorbell(self, pipe, new_tr_head):
+		if self.tr: self.tr(TR_DOORBELL, pipe, 0, new_tr_head)
+		if self.idle: self.idle.kick()
+		doorbell = pipe2db(pipe)
+		if doorbell != 6:
+			self.mmiowrite32(DOORBELL_05, new_tr_head << 16 | doorbell << 8 | 0x20)
+		else:
+			self.mmiowrite32(DOORBELL_6, 1)
+
+	def send_transfer(self, pipe, data, wait=True):
+		slot = self.submit(pipe, data, wait)
+		if wait and not slot.wait(self.cfg.wait_timeout):
+			raise self.timed_out(f"no completion on pipe {pipe}")
+
+	def send_batch(self, pipe, messages):
+		"""Queue messages back to back, ring the doorbell once and then wait for all of them"""
+		slots = [self.submit(pipe, data, True, False) for data in messages]
+		self.ring_doorbell(pipe, self.get_tr_head(pipe))
+		for slot in slots:
+			if not slot.wait(self.cfg.wait_timeout):
+				raise self.timed_out(f"{sum(not slot.evt.is_set() for slot in slots)} of {len(slots)} messages on pipe {pipe} never completed")
+
+	def submit(self, pipe, data, arm=False, doorbell=True):
+		if pipe not in self.msg_ids:
+			msg_id = 0
+		else:
+			msg_id = self.msg_ids[pipe]
+
+		tr_buf, tr_ring_sz, tr_ent_sz = self.transfer_ring_infos[pipe]
+		tr_mem = tr_buf.mem
+
+		tr_head = self.get_tr_head(pipe)
+		deadline = None
+		# the firmware moves the tail as soon as it reads an entry, well before
+		# it completes it, so a free ring slot doesn't mean the msg_id is free
+		while (tr_head + 1) % tr_ring_sz == self.get_tr_tail(pipe) or self.msg_id_busy(pipe, msg_id):
+			# wait for the firmware to catch up
+			if self.recovering:
+				raise RingReset()
+			if deadline is None:
+				deadline = time.monotonic() + self.cfg.wait_timeout
+			elif time.monotonic() > deadline:
+				raise self.timed_out(f"pipe {pipe} ring full or msg_id {msg_id} still in flight")
+			os.sched_yield()
+		tr_off = tr_head*tr_ent_sz
+		if pipe in RX_PIPES:
+			# posting a receive buffer, data is the DmaBuf for the firmware to fill
+			assert arm == False
+			len_ = data.size
+			self.rx_posted[pipe][msg_id] = data
+			xfer_iova = data.iova
+			flags = 1
+		else:
+			len_ = len(data)
+			if len_ <= tr_ent_sz - TRANSFERHEADER_SZ:
+				# inline in the footer
+				tr_mem[tr_off+TRANSFERHEADER_SZ:tr_off+TRANSFERHEADER_SZ+len_] = data
+				xfer_iova = 0
+				flags = 2
+				self.tx_inline[pipe] += 1
+			else:
+				# XXX only seen the firmware take these on pipes 0 and 5
+				xfer_buf = self.arena.alloc(len_, tag=self.tx_tags[pipe], zero=False)
+				xfer_buf.mem[:] = data
+				self.tx_inflight[pipe][msg_id] = xfer_buf
+				xfer_iova = xfer_buf.iova
+				flags = 1
+				self.tx_indirect[pipe] += 1
+				if len_ > self.tx_indirect_max[pipe]:
+					self.tx_indirect_max[pipe] = len_
+
+		transfer_hdr = TransferHeader(
+			flags=flags,
+			len_=len_,
+			unk_0x3_=b'\x00',
+			buf_iova=xfer_iova,
+			msg_id=msg_id,
+			unk_0xe_=b'\x00\x00'
+		)
+		transfer_hdr_ = struct.pack(TRANSFERHEADER_STR, *transfer_hdr)
+		# chexdump(transfer_hdr_)
+		tr_mem[tr_off:tr_off+TRANSFERHEADER_SZ] = transfer_hdr_
+		new_tr_head = (tr_head + 1) % tr_ring_sz
+		self.set_tr_head(pipe, new_tr_head)
+		self.barrier()
+
+		if self.tr: self.tr(TR_SUBMIT, pipe, msg_id, len_)
+
+		slot = self.completions.arm(pipe, msg_id) if arm else None
+		self.msg_ids[pipe] = (msg_id + 1) % tr_ring_sz
+
+		if doorbell:
+			self.ring_doorbell(pipe, new_tr_head)
+		return slot
+
+	def msg_id_busy(self, pipe, msg_id):
+		return msg_id in self.tx_inflight[pipe] or msg_id in self.rx_posted[pipe] or self.completions.slots[pipe][msg_id].armed
+
+	# XXX this function might be busticated
+	def boop_cr(self, pipe, count=1):
+		tr_head = self.get_tr_head(pipe)
+		new_tr_head = (tr_head + count) % self.transfer_ring_infos[pipe][1]
+		self.set_tr_head(pipe, new_tr_head)
+
+		self.ring_doorbell(pipe, new_tr_head)
+
+	def queue_transfer(self, pipe, data):
+		worker = self.workers[pipe]
+		if worker is None:
+			self.send_transfer(pipe, data, False)
+		else:
+			worker.put(data)
+
+	def queue_boop(self, pipe):
+		worker = self.workers[pipe]
+		if worker is None:
+			self.boop_cr(pipe)
+		else:
+			worker.put(None)
+
+	def start_workers(self):
+		pipes = [pipe for pipe in self.transfer_ring_infos if pipe != 0]
+		cpus = self.cfg.submit_cpus or [None]
+		for i, pipe in enumerate(sorted(pipes)):
+			self.workers[pipe] = PipeWorker(self, pipe, cpu=cpus[i % len(cpus)])
+
+	def report_workers(self):
+		for worker in self.workers:
+			if worker is not None and worker.batches:
+				self.log(f"pipe {worker.pipe} worker: {worker.items} sends in {worker.batches} batches, avg {worker.items/worker.batches:.1f} max {worker.max_batch}")
+
+	def rings_idle(self):
+		if self.recovering or not self.recovered.is_set() or any(self.tx_inflight):
+			return False
+		for pipe in self.transfer_ring_infos:
+			if self.get_tr_head(pipe) != self.get_tr_tail(pipe):
+				return False
+		for cr_idx in self.completion_ring_infos:
+			if self.get_cr_head(cr_idx) != self.get_cr_tail(cr_idx):
+				return False
+		return True
+
+	def quiesce(self):
+		self.mmiowrite32(RTI_SLEEP_CONTROL, SLEEP_CONTROL_QUIESCE)
+
+	def unquiesce(self):
+		self.mmiowrite32(RTI_SLEEP_CONTROL, SLEEP_CONTROL_UNQUIESCE)
+
+	def recv_from_pipe(self, pipe):
+		slot = self.completions.arm_next(pipe)
+
+		self.boop_cr(pipe)
+
+		if not slot.wait(self.cfg.wait_timeout):
+			raise self.timed_out(f"nothing received on pipe {pipe}")
+		return slot.payload
+
+	def irq_wait(self):
+		if not self.py_irq_evt.wait(self.cfg.wait_timeout):
+			raise self.timed_out("no interrupt")
+		self.py_irq_evt.clear()
+
+	def chip_init(self):
+		self.hw.reset()
+
+		# bus master
+		self.hw.cfgwrite16(4, self.hw.cfgread16(4) | 0x4)
+
+		self.hw.cfgwrite32(0x80, 0x18002000)
+		self.hw.cfgwrite32(0x70, 0x18109000)
+		self.hw.cfgwrite32(0x74, 0x18011000)
+		self.hw.cfgwrite32(0x78, 0x18106000)
+		self.hw.cfgwrite32(0x84, 0x19000000)
+
+		reset_thing = self.hw.cfgread32(0x88)
+		self.log(f"reset thing {reset_thing:08X}")
+		if reset_thing & 0x80000 == 0:
+			reset_thing &= 0xfff6ffff
+		self.hw.cfgwrite32(0x88, reset_thing | 0x10000)
+
+	def map_window(self):
+		self.arena = DmaArena(self.hw, self.iova_start, self.shared_mem_sz,
+			backing=self.cfg.dma_backing, prefault=self.cfg.dma_prefault,
+			lock_mem=self.cfg.dma_mlock, log=self.log)
+
+	def alloc_ring(self, count, ent_sz, tag):
+		ring_buf = self.arena.alloc(count * ent_sz, tag=tag)
+		self.ring_bufs.append(ring_buf)
+		return ring_buf
+
+	def load_image(self):
+		# kept loaded after boot so recovery can reboot the chip straight away
+		if self.fw_buf is None:
+			firmware = read_blob(self.cfg.firmware)
+			self.fw_sz = len(firmware)
+			# the image has to sit at the start of the window
+			self.fw_buf = self.arena.alloc(max(roundto(self.fw_sz, 0x200), PAGE_SZ), align=PAGE_SZ, tag='firmware')
+			assert self.fw_buf.iova == self.iova_start
+			self.fw_buf.mem[:self.fw_sz] = firmware
+
+		fw_sz = self.fw_sz
+		fw_sz_up = roundto(fw_sz, 0x200)
+		self.log(f"fw size {fw_sz:x}")
+
+		time.sleep(self.hw.boot_delay)
+
+		self.log(self.mmioread32(BOOTSTAGE))
+
+		self.mmiowrite32(DOORBELL_6, 1)
+		self.mmiowrite32(BTI_MSI_LO, 0xfffff000)
+		self.mmiowrite32(BTI_MSI_HI, 0)
+		self.mmiowrite32(REG_24, 0x200)
+		self.mmiowrite32(REG_21, 0x100)
+		self.mmiowrite32(DOORBELL_6, 1)
+		self.mmiowrite32(BTI_MSI_LO, 0xfffff000)
+		self.mmiowrite32(BTI_MSI_HI, 0)
+		self.mmiowrite32(REG_24, 0x200)
+		self.mmiowrite32(REG_21, 0x100)
+		self.mmiowrite32(HOST_WINDOW_LO, self.iova_start)
+		self.mmiowrite32(HOST_WINDOW_HI, 0)
+		self.mmiowrite32(BAR1_IMG_ADDR_LO, self.iova_start)
+		self.mmiowrite32(BAR1_IMG_ADDR_HI, 0)
+		self.mmiowrite32(HOST_WINDOW_SZ, fw_sz_up)
+		self.mmiowrite32(REG_21, 0x200)
+		self.mmiowrite32(BAR1_IMG_SZ, fw_sz)
+
+		self.log(self.mmioread32(BOOTSTAGE))
+		self.mmiowrite32(IMG_DOORBELL, 0)
+		self.log(self.mmioread32(BOOTSTAGE))
+
+		self.irq_wait()
+		self.log(self.mmioread32(BOOTSTAGE))
+		self.log(self.mmioread32(RTI_GET_CAPABILITY))
+
+	def rti_init(self):
+		self.mmiowrite32(REG_21, 0x100)
+		self.mmiowrite32(RTI_MSI_LO, 0xfffff000)
+		self.mmiowrite32(RTI_MSI_HI, 0)
+		self.mmiowrite32(RTI_MSI_DATA, 0)
+		self.mmiowrite32(HOST_WINDOW_LO, self.iova_start)
+		self.mmiowrite32(HOST_WINDOW_HI, 0)
+		self.mmiowrite32(HOST_WINDOW_SZ, self.shared_mem_sz)
+		self.mmiowrite32(REG_21, 0x200)
+		self.mmiowrite32(RTI_CONTROL, 1)
+
+		self.irq_wait()
+		self.log("Control is now 1")
+
+		self.ctx_buf = ctx_buf = self.arena.alloc(CONTEXTSTRUCT_SZ, tag='context')
+		self.per_info = self.arena.alloc(PER_INFO_SZ, tag='per info')
+		self.ring_idx_buf = ring_idx_buf = self.arena.alloc(RING_IDX_SZ, tag='ring indexes')
+		self.ring_idx = ring_idx_buf.mem
+		tr0_buf = self.alloc_ring(128, TRANSFERHEADER_SZ, 'TR0')
+		cr0_buf = self.alloc_ring(128, COMPLETIONHEADER_SZ, 'CR0')
+
+		ctx = ContextStruct(
+			version=1,
+			sz=CONTEXTSTRUCT_SZ,
+			enabled_caps=0xa,
+			perInfo=self.per_info.iova,
+			crHIA=ring_idx_buf.iova + completion_rings_heads_off,
+			crTIA=ring_idx_buf.iova + completion_rings_tails_off,
+			trHIA=ring_idx_buf.iova + transfer_rings_heads_off,
+			trTIA=ring_idx_buf.iova + transfer_rings_tails_off,
+			crIAEntry=self.num_crs,
+			trIAEntry=NUM_TRANSFER_RINGS,
+			mcr=cr0_buf.iova,
+			mtr=tr0_buf.iova,
+			mtrEntry=128,
+			mcrEntry=128,
+			mtrDb=0,
+			mcrDb=0xffff,
+			mtrMsi=0,
+			mcrMsi=0,
+			mtrOptHeadSize=0,
+			mtrOptFootSize=0,
+			mcrOptHeadSize=0,
+			mcrOptFootSize=0,
+			res_inPlaceComp_oOOComp=CTX_OOO_COMP if self.cfg.ooo_completions else 0,
+			piMsi=0,
+			scratchPa=0,
+			scratchSize=0,
+			res=0
+		)
+		ctx_ = struct.pack(CONTEXTSTRUCT_STR, *ctx)
+		chexdump(ctx_, print_fn=self.log)
+
+		ctx_buf.mem[:] = ctx_
+		self.barrier()
+
+		self.irq_do_main_stuff = True
+		self.mmiowrite32(RTI_WINDOW_LO, self.iova_start)
+		self.mmiowrite32(RTI_WINDOW_HI, 0)
+		self.mmiowrite32(RTI_WINDOW_SZ, self.shared_mem_sz)
+		self.mmiowrite32(RTI_CONTEXT_LO, ctx_buf.iova)
+		self.mmiowrite32(RTI_CONTEXT_HI, 0)
+		self.mmiowrite32(RTI_CONTROL, 2)
+
+		self.irq_wait()
+		self.log("Control is now 2")
+
+		self.transfer_ring_infos[0] = (tr0_buf, 128, TRANSFERHEADER_SZ)
+		self.completion_ring_infos[0] = (cr0_buf, 128, COMPLETIONHEADER_SZ)
+
+	def completion_ring_message(self, i):
+		self.log(f"opening CR{i}")
+		if i == 1 or i == 2:
+			ring_ents = 256
+		else:
+			ring_ents = 128
+
+		if i == 1 or i == 3:
+			foot_sz = 0
+		else:
+			foot_sz = 66
+		ring_ent_sz = COMPLETIONHEADER_SZ + foot_sz*4
+
+		if i == 1 or i == 2:
+			intmod_delay = 1000
+		else:
+			intmod_delay = 0
+
+		ring_buf = self.alloc_ring(ring_ents, ring_ent_sz, f'CR{i}')
+		self.completion_ring_infos[i] = (ring_buf, ring_ents, ring_ent_sz)
+
+		opencr = OpenCompletionRingMessage(
+			msg_type=2,
+			head_size=0,
+			foot_size=foot_sz,
+			pad_0x3_=b'\x00',
+			cr_idx=i,
+			cr_idx_=i,
+			ring_iova=ring_buf.iova,
+			ring_count=ring_ents,
+			unk_0x12_=0xffffffff,
+			pad_0x16_=b'\x00\x00\x00\x00\x00\x00',
+			msi=0,
+			intmod_delay=intmod_delay,
+			intmod_bytes=0xffffffff,
+			accum_delay=0,
+			accum_bytes=0,
+			pad_0x2a_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00',
+		)
+		self.log(opencr)
+		opencr_ = struct.pack(OPENCOMPLETIONRING_STR, *opencr)
+		# chexdump(opencr_)
+		return opencr_
+
+	def pipe_message(self, pipe_idx, foot_size, completion_ring_index, flags):
+		if flags & 0x80:
+			# virtual
+			ring_buf = None
+			ring_iova = 0
+		else:
+			ring_buf = self.alloc_ring(128, TRANSFERHEADER_SZ + foot_size*4, f'TR{pipe_idx}')
+			ring_iova = ring_buf.iova
+		self.transfer_ring_infos[pipe_idx] = (ring_buf, 128, TRANSFERHEADER_SZ + foot_size*4)
+
+		openpipe = make_openpipe(pipe_idx, foot_size, ring_iova, completion_ring_index, flags)
+		self.log(openpipe)
+		openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
+		# chexdump(openpipe_)
+		return openpipe_
+
+	def open_rings(self, crs, pipes):
+		# all queued on pipe 0 at once, the firmware works through them in order
+		messages = [self.completion_ring_message(i) for i in crs]
+		messages += [self.pipe_message(*pipe) for pipe in pipes]
+		self.send_batch(0, messages)
+
+	def hci_pipes(self):
+		return [
+			(1, self.footer_sizes[1], 1, 0),
+			(2, 0, 2, 0x80),
+		]
+
+	def send_blob(self, commands):
+		for command in commands:
+			self.send_transfer(1, command)
+			self.recv_from_pipe(2)
+
+	def load_calibration(self):
+		# BLOB
+		self.send_blob(calibration_commands(read_blob(self.cfg.calibration)))
+
+		# PTB
+		self.send_blob(ptb_commands(read_blob(self.cfg.ptb)))
+
+		# reset
+		self.send_transfer(1, b'\x03\x0c\x00')
+		self.recv_from_pipe(2)
+
+	def data_pipes(self):
+		pipes = [
+			# SCO pipes
+			(3, self.footer_sizes[3], 3, 0x100),
+			(4, 0, 4, 0x180),
+
+			# ACL pipes
+			(5, self.footer_sizes[5], 1, 0),
+			(6, 0, 2, 0),
+		]
+		if self.cfg.debug_log is not None:
+			pipes.append((8, 0, DEBUG_CR, 0))
+		return pipes
+
+	def post_rx_buffers(self):
+		for _ in range(ACL_RX_BUFS):
+			self.send_transfer(6, self.arena.alloc(ACL_RX_BUF_SZ, tag='pipe6 rx'), False)
+
+		if self.cfg.debug_log is not None:
+			if self.fwlog is None:
+				self.fwlog = FirmwareLog(self.cfg.debug_log, self.cfg.debug_log_max_bytes, self.cfg.debug_log_backups, self.cfg.name)
+			for _ in range(DEBUG_RX_BUFS):
+				self.send_transfer(8, self.arena.alloc(DEBUG_RX_BUF_SZ, tag='pipe8 rx'), False)
+
+	def start_firmware(self):
+		self.load_image()
+		self.rti_init()
+		self.open_rings(range(1, self.num_crs), self.hci_pipes())
+		self.load_calibration()
+		self.open_rings([], self.data_pipes())
+
+		self.boop_cr(2)
+		self.boop_cr(4)
+		self.post_rx_buffers()
+		self.irq_do_magic = True
+
+	def bring_up(self):
+		self.chip_init()
+		self.map_window()
+
+		self.irqthread = threading.Thread(target=self.interrupt_handler, daemon=True)
+		self.irqthread.start()
+		self.hw.enable_irq()
+
+		if self.cfg.vhci is not None and self.vhci_fd is None:
+			self.vhci_fd = os.open(self.cfg.vhci, os.O_RDWR)
+			# os.write(self.vhci_fd, b'\xff\x00')
+
+		self.start_firmware()
+
+		if self.cfg.idle_timeout is not None:
+			self.idle = IdleManager(self, self.cfg.idle_timeout, self.log)
+		if self.cfg.submit_workers:
+			self.start_workers()
+		if self.cfg.stall_timeout is not None:
+			self.watchdog = Watchdog(self, self.cfg.stall_timeout / 4, self.cfg.stall_timeout, self.log)
+
+		self.arena.report_mappings(self.log)
+
+	def handle_vhci_packet(self, vhci_packet):
+		if self.pktdump: self.pktdump(vhci_packet, "vhci out")
+		# sliced as a view so the payload is only copied once, into the ring or its buffer
+		payload = memoryview(vhci_packet)[1:]
+		if vhci_packet[0] == 0x01:
+			# self.log("HCI out")
+			self.queue_transfer(1, payload)
+		elif vhci_packet[0] == 0x02:
+			# self.log("\x1b[31mACL out\x1b[0m")
+			# chexdump(vhci_packet)
+			self.queue_transfer(5, payload)
+		elif vhci_packet[0] == 0x03:
+			# self.log("\x1b[31mSCO out\x1b[0m")
+			# chexdump(vhci_packet)
+			self.queue_transfer(3, payload)
+		elif vhci_packet[0] == 0xff:
+			self.log("vendor command")
+		else:
+			self.log("UNKNOWN VHCI command")
+
+	def run_vhci(self):
+		vhci_fd = self.vhci_fd
+		while self.running:
+			vhci_packet = os.read(vhci_fd, 1024)
+			if not vhci_packet:
+				break
+			while True:
+				self.recovered.wait()
+				if not self.running:
+					return
+				with self.tx_gate:
+					if not self.recovered.is_set():
+						# a recovery got the gate first and failed
+						continue
+					try:
+						self.handle_vhci_packet(vhci_packet)
+						break
+					except RingReset:
+						pass
+					except DeviceTimeout:
+						if self.watchdog is None:
+							raise
+
+	def tx_pipes(self):
+		return [pipe for pipe, (ring_buf, _, _) in self.transfer_ring_infos.items() if ring_buf is not None and pipe not in RX_PIPES]
+
+	def snapshot(self):
+		regs = {name: self.mmioread32(reg) for name, reg in ERROR_REGS}
+		trs = {pipe: (self.get_tr_head(pipe), self.get_tr_tail(pipe), len(self.tx_inflight[pipe])) for pipe in self.transfer_ring_infos}
+		crs = {cr_idx: (self.get_cr_head(cr_idx), self.get_cr_tail(cr_idx)) for cr_idx in self.completion_ring_infos}
+		return regs, trs, crs
+
+	def timed_out(self, what):
+		"""Log the device state and leave it for the watchdog to reset, returns the exception to raise"""
+		self.log_snapshot()
+		self.recovered.clear()
+		self.needs_recovery = what
+		return DeviceTimeout(what)
+
+	def log_snapshot(self):
+		if self.ring_idx is None:
+			return
+		regs, trs, crs = self.snapshot()
+		for name, val in regs.items():
+			self.log(f"{name} {val:08x}")
+		for pipe, (head, tail, inflight) in trs.items():
+			self.log(f"TR{pipe} head {head} tail {tail} in flight {inflight}")
+		for cr_idx, (head, tail) in crs.items():
+			self.log(f"CR{cr_idx} head {head} tail {tail}")
+
+	def pending_tx(self):
+		"""Packets sitting in the TX rings that the firmware never picked up"""
+		pending = []
+		for pipe in self.tx_pipes():
+			if pipe == 0:
+				continue
+			tr_buf, tr_ring_sz, tr_ent_sz = self.transfer_ring_infos[pipe]
+			tail = self.get_tr_tail(pipe)
+			head = self.get_tr_head(pipe)
+			while tail != head:
+				off = tail*tr_ent_sz
+				hdr = TransferHeader._make(struct.unpack_from(TRANSFERHEADER_STR, tr_buf.mem, off))
+				if hdr.flags & 2:
+					pending.append((pipe, bytes(tr_buf.mem[off+TRANSFERHEADER_SZ:off+TRANSFERHEADER_SZ+hdr.len_])))
+				elif hdr.msg_id in self.tx_inflight[pipe]:
+					pending.append((pipe, bytes(self.tx_inflight[pipe][hdr.msg_id].mem[:hdr.len_])))
+				tail = (tail + 1) % tr_ring_sz
+		return pending
+
+	def teardown(self):
+		# safe to call again after a recovery that failed half way
+		for bufs in self.tx_inflight + self.rx_posted:
+			for buf in bufs.values():
+				self.arena.free(buf)
+			bufs.clear()
+		for ring_buf in self.ring_bufs:
+			self.arena.free(ring_buf)
+		self.ring_bufs.clear()
+		self.transfer_ring_infos.clear()
+		self.completion_ring_infos.clear()
+		for buf in (self.ctx_buf, self.per_info, self.ring_idx_buf):
+			if buf is not None:
+				self.arena.free(buf)
+		self.ctx_buf = self.per_info = self.ring_idx_buf = None
+		self.ring_idx = None
+		self.msg_ids.clear()
+		# anything still armed belongs to the old rings
+		self.completions = CompletionTable()
+
+	def recover(self, reason):
+		"""
+		Reset the chip and bring it back up on the same arena and VHCI fd.
+		Packets the firmware hadn't consumed yet are sent again afterwards,
+		anything still queued in VHCI just waits.
+		"""
+		start = time.perf_counter_ns()
+		self.log(f"recovering: {reason}")
+		self.log_snapshot()
+
+		self.recovered.clear()
+		self.needs_recovery = reason
+		self.recovering = True
+		workers = [worker for worker in self.workers if worker is not None]
+		parked = []
+		try:
+			with self.tx_gate:
+				# park the ring owners, we're the only one touching the rings from here on
+				for worker in workers:
+					worker.lock.acquire()
+					parked.append(worker)
+				with self.irq_lock:
+					# only set once start_firmware got all the way through
+					was_up = self.irq_do_magic
+					self.irq_do_main_stuff = False
+					self.irq_do_magic = False
+				if was_up:
+					# otherwise the rings hold what the last failed attempt was sending
+					self.resend += self.pending_tx()
+				# reposts and boops queued for the old rings, start_firmware does its own
+				for worker in workers:
+					if worker.virtual or worker.pipe in RX_PIPES:
+						worker.q.discard()
+				self.teardown()
+
+				self.chip_init()
+				self.hw.enable_irq()
+				self.py_irq_evt.clear()
+				self.start_firmware()
+
+				self.recovering = False
+				resend, self.resend = self.resend, []
+				for pipe, data in resend:
+					self.send_transfer(pipe, data, False)
+
+				# only now can VHCI and the workers carry on
+				self.needs_recovery = None
+				self.recovered.set()
+		finally:
+			self.recovering = False
+			for worker in parked:
+				worker.lock.release()
+
+		self.recoveries += 1
+		self.log(f"recovered in {(time.perf_counter_ns() - start)/1e6:.1f} ms, {len(resend)} packets resent")
+
+	def dump_trace(self):
+		if self.tracebuf is not None:
+			self.tracebuf.dump(self.cfg.trace)
+			self.log(f"trace written to {self.cfg.trace}")
+
+	def report_tx_placement(self):
+		for pipe in range(NUM_TRANSFER_RINGS):
+			if self.tx_inline[pipe] or self.tx_indirect[pipe]:
+				# from the config, the rings may be gone by now
+				foot_sz = self.footer_sizes.get(pipe, 0) * 4
+				self.log(f"TX pipe {pipe}: {self.tx_inline[pipe]} inline (footer {foot_sz} bytes), {self.tx_indirect[pipe]} indirect (largest {self.tx_indirect_max[pipe]} bytes)")
+
+	def dump_dma(self, path):
+		with open(path, 'w') as f:
+			self.arena.dump(f)
+		self.log(f"DMA memory written to {path}")
+
+	def close(self):
+		self.running = False
+		if self.watchdog is not None:
+			self.watchdog.close()
+		# wake anything still waiting on a recovery that isn't coming
+		self.recovered.set()
+		for worker in self.workers:
+			if worker is not None:
+				worker.close()
+		self.report_workers()
+		if self.idle is not None:
+			self.idle.close()
+			self.idle.report()
+		os.eventfd_write(self.hw.irqfd, 1)
+		self.hw.close()
+		self.dump_trace()
+		if self.fwlog is not None:
+			self.fwlog.close()
+			if self.fwlog.dropped:
+				self.log(f"{self.fwlog.dropped} firmware log records dropped")
+		self.report_tx_placement()
+		if self.arena is not None:
+			self.arena.report(self.log)
+
+
+def calibration_commands(cal_blob):
+	remaining_count = divroundup(len(cal_blob), 0xe6) - 1
+	for chunk_off in range(0, len(cal_blob), 0xe6):
+		blob_chunk = cal_blob[chunk_off:chunk_off+0xe6]
+		if len(blob_chunk) != 0xe6:
+			blob_chunk += b'\x00' * (0xe6 - len(blob_chunk))
+		yield struct.pack("<HBBH", 0xfd97, 0xe9, 0x03, remaining_count) + blob_chunk
+		remaining_count -=1
+	assert remaining_count == -1
+
+def ptb_commands(ptb_blob):
+	remaining_count = divroundup(len(ptb_blob), 0xcf) - 1
+	for chunk_off in range(0, len(ptb_blob), 0xcf):
+		blob_chunk = ptb_blob[chunk_off:chunk_off+0xcf]
+		if len(blob_chunk) != 0xcf:
+			blob_chunk += b'\x00' * (0xcf - len(blob_chunk))
+		yield struct.pack("<HBH", 0xfe0d, 0xd1, remaining_count) + blob_chunk
+		remaining_count -=1
+	assert remaining_count == -1
@@ -0,0 +1,282 @@
+from ctypes import *
+import mmap
+import os
+import tempfile
+import threading
+import time
+
+from util import *
+
+
+# VFIO needs 16k pages on these machines
+PAGE_SZ = 0x4000
+# small objects get carved out of single pages
+SLAB_CLASSES = (64, 256, 1024, 4096)
+DEFAULT_REGION_SZ = 0x100000
+
+# not exported by the mmap module
+MAP_HUGETLB = getattr(mmap, 'MAP_HUGETLB', 0x40000)
+
+_libc = None
+def mlock(mem):
+	global _libc
+	if _libc is None:
+		_libc = CDLL('libc.so.6', use_errno=True)
+		_libc.mlock.argtypes = [c_void_p, c_size_t]
+		_libc.mlock.restype = c_int
+	if _libc.mlock(addressof(c_char.from_buffer(mem)), len(mem)) != 0:
+		errno = get_errno()
+		raise OSError(errno, os.strerror(errno))
+
+def hugepage_sz():
+	try:
+		with open('/proc/meminfo') as f:
+			for line in f:
+				if line.startswith('Hugepagesize:'):
+					return int(line.split()[1]) * 1024
+	except OSError:
+		pass
+	return None
+
+def is_hugetlbfs(path):
+	"""Whether path is on a hugetlbfs mount, going by the deepest mount point above it"""
+	path = os.path.realpath(path)
+	fstype = None
+	best = ''
+	try:
+		with open('/proc/mounts') as f:
+			for line in f:
+				_, mnt, mnt_type = line.split()[:3]
+				mnt = mnt.replace('\\040', ' ')
+				if (path == mnt or path.startswith(mnt.rstrip('/') + '/')) and len(mnt) >= len(best):
+					best, fstype = mnt, mnt_type
+	except OSError:
+		return False
+	return fstype == 'hugetlbfs'
+
+
+class DmaBuf:
+	__slots__ = ('region', 'off', 'size', 'iova', 'mem', 'tag', 'slab')
+
+	def __init__(self, region, off, size, tag, slab=None):
+		self.region = region
+		self.off = off
+		self.size = size
+		self.iova = region.iova + off
+		self.mem = region.view[off:off+size]
+		self.tag = tag
+		self.slab = slab
+
+	def __repr__(self):
+		return f"DmaBuf({self.tag!r}, iova={self.iova:#x}, size={self.size:#x})"
+
+
+class DmaRegion:
+	"""One VFIO_IOMMU_MAP_DMA mapping, large allocations are first-fit out of it"""
+
+	def __init__(self, iova, mem, backing='anon', map_ns=0):
+		self.iova = iova
+		self.size = len(mem)
+		self.mem = mem
+		self.backing = backing
+		# how long mmap + prefault + mlock + VFIO_IOMMU_MAP_DMA took
+		self.map_ns = map_ns
+		self.view = memoryview(mem)
+		# sorted (off, size)
+		self.free = [(0, self.size)]
+
+	def take(self, size, align):
+		for i, (off, sz) in enumerate(self.free):
+			start = roundto(self.iova + off, align) - self.iova
+			if start + size > off + sz:
+				continue
+			new = []
+			if start > off:
+				new.append((off, start - off))
+			if start + size < off + sz:
+				new.append((start + size, off + sz - start - size))
+			self.free[i:i+1] = new
+			return start
+		return None
+
+	def give(self, off, size):
+		i = 0
+		while i < len(self.free) and self.free[i][0] < off:
+			i += 1
+		self.free.insert(i, (off, size))
+		# merge with the next one, then the previous one
+		if i + 1 < len(self.free) and off + size == self.free[i+1][0]:
+			self.free[i:i+2] = [(off, size + self.free[i+1][1])]
+		if i > 0 and self.free[i-1][0] + self.free[i-1][1] == off:
+			self.free[i-1:i+1] = [(self.free[i-1][0], self.free[i-1][1] + self.free[i][1])]
+
+
+class DmaSlab:
+	def __init__(self, region, off, obj_sz):
+		self.region = region
+		self.off = off
+		self.obj_sz = obj_sz
+		self.free = list(range(off, off + PAGE_SZ, obj_sz))
+
+
+class DmaArena:
+	"""
+	Hands out DMA-able buffers from the IOVA window given to the firmware.
+
+	The window is only reserved up front; backing memory is mapped a region at
+	a time as allocations need it. Anything up to the largest slab class comes
+	from a per-size slab and is aligned to its size class, anything bigger is
+	page aligned. Live allocations are counted per tag so leaks show up.
+
+	backing is 'anon' for normal pages, 'hugetlb' for MAP_HUGETLB, or the path
+	of a hugetlbfs mount. If hugepages can't be had it quietly falls back to
+	normal pages (after saying so once).
+	"""
+
+	def __init__(self, hw, iova_start, window_sz, region_sz=DEFAULT_REGION_SZ,
+			backing='anon', prefault=False, lock_mem=False, log=print):
+		self.hw = hw
+		self.iova_start = iova_start
+		self.window_sz = window_sz
+		self.region_sz = region_sz
+		self.backing = backing
+		self.prefault = prefault
+		self.lock_mem = lock_mem
+		self.log = log
+		self.huge_sz = hugepage_sz() if backing != 'anon' else None
+		if backing != 'anon' and self.huge_sz is None:
+			self.log("DMA: no hugepage support, using normal pages")
+			self.backing = 'anon'
+		elif backing not in ('anon', 'hugetlb') and not is_hugetlbfs(backing):
+			self.log(f"DMA: {backing} is not a hugetlbfs mount, using normal pages")
+			self.backing = 'anon'
+		self.next_iova = iova_start
+		self.regions = []
+		self.slabs = {obj_sz: [] for obj_sz in SLAB_CLASSES}
+		self.live = {}
+		self.lock = threading.Lock()
+
+	def _mmap_huge(self, size, populate):
+		if self.backing == 'hugetlb':
+			return mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | MAP_HUGETLB | populate, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+
+		fd, path = tempfile.mkstemp(prefix='btdma-', dir=self.backing)
+		try:
+			os.unlink(path)
+			os.ftruncate(fd, size)
+			return mmap.mmap(fd, size, flags=mmap.MAP_SHARED | populate, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+		finally:
+			os.close(fd)
+
+	def map_region(self, size):
+		size = roundto(max(size, self.region_sz), PAGE_SZ)
+		iova = self.next_iova
+		window_end = self.iova_start + self.window_sz
+		if iova + size > window_end:
+			raise MemoryError(f"DMA window exhausted ({size:#x} more bytes wanted)")
+
+		t0 = time.perf_counter_ns()
+		populate = mmap.MAP_POPULATE if self.prefault else 0
+		mem = None
+		backing = self.backing
+		if backing != 'anon':
+			huge_size = roundto(size, self.huge_sz)
+			if iova + huge_size <= window_end:
+				try:
+					mem = self._mmap_huge(huge_size, populate)
+				except OSError as e:
+					self.log(f"DMA: hugepage mapping failed ({e}), using normal pages")
+					self.backing = 'anon'
+		if mem is None:
+			backing = 'anon'
+			mem = mmap.mmap(-1, size, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS | populate, prot=mmap.PROT_READ | mmap.PROT_WRITE)
+		if self.lock_mem:
+			try:
+				mlock(mem)
+			except OSError as e:
+				self.log(f"DMA: mlock failed ({e})")
+				self.lock_mem = False
+		self.hw.map_dma(mem, iova)
+		map_ns = time.perf_counter_ns() - t0
+
+		region = DmaRegion(iova, mem, backing, map_ns)
+		self.regions.append(region)
+		self.next_iova += region.size
+		return region
+
+	def _take_pages(self, size, align):
+		for region in self.regions:
+			off = region.take(size, align)
+			if off is not None:
+				return region, off
+		region = self.map_region(size + align - PAGE_SZ)
+		return region, region.take(size, align)
+
+	def alloc(self, size, align=16, tag=None, zero=True):
+		with self.lock:
+			obj_sz = next((obj_sz for obj_sz in SLAB_CLASSES if obj_sz >= max(size, align)), None)
+			if obj_sz is not None:
+				slab = next((slab for slab in self.slabs[obj_sz] if slab.free), None)
+				if slab is None:
+					region, off = self._take_pages(PAGE_SZ, PAGE_SZ)
+					slab = DmaSlab(region, off, obj_sz)
+					self.slabs[obj_sz].append(slab)
+				buf = DmaBuf(slab.region, slab.free.pop(), size, tag, slab)
+			else:
+				region, off = self._take_pages(roundto(size, PAGE_SZ), max(align, PAGE_SZ))
+				buf = DmaBuf(region, off, size, tag)
+
+			count, nbytes = self.live.get(tag, (0, 0))
+			self.live[tag] = (count + 1, nbytes + size)
+
+		if zero:
+			buf.mem[:] = bytes(size)
+		return buf
+
+	def free(self, buf):
+		with self.lock:
+			count, nbytes = self.live[buf.tag]
+			assert count > 0
+			self.live[buf.tag] = (count - 1, nbytes - buf.size)
+
+			if buf.slab is not None:
+				assert buf.off not in buf.slab.free
+				buf.slab.free.append(buf.off)
+			else:
+				buf.region.give(buf.off, roundto(buf.size, PAGE_SZ))
+
+	def translate(self, iova):
+		"""iova -> (region, offset)"""
+		for region in self.regions:
+			if region.iova <= iova < region.iova + region.size:
+				return region, iova - region.iova
+		raise ValueError(f"iova {iova:#x} is not mapped")
+
+	def iova_to_mem(self, iova, size):
+		region, off = self.translate(iova)
+		assert off + size <= region.size
+		return region.view[off:off+size]
+
+	def outstanding(self):
+		return {tag: v for tag, v in self.live.items() if v[0]}
+
+	def mapped_sz(self):
+		return sum(region.size for region in self.regions)
+
+	def map_cost(self):
+		return sum(region.map_ns for region in self.regions)
+
+	def report_mappings(self, log=print):
+		for region in self.regions:
+			log(f"DMA: region {region.iova:#x} size {region.size:#x} {region.backing} mapped in {region.map_ns/1e6:.3f} ms")
+		log(f"DMA: {len(self.regions)} regions, {self.mapped_sz():#x} of {self.window_sz:#x} mapped in {self.map_cost()/1e6:.3f} ms")
+
+	def dump(self, f):
+		for region in self.regions:
+			f.write(f"region {region.iova:#x} size {region.size:#x}\n")
+			chexdump_file(f, region.mem, region.iova)
+
+	def report(self, log=print):
+		log(f"DMA: {len(self.regions)} regions, {self.mapped_sz():#x} of {self.window_sz:#x} mapped")
+		for tag, (count, nbytes) in sorted(self.outstanding().items(), key=str):
+			log(f"DMA: {tag}: {count} live, {nbytes:#x} bytes")
@@ -0,0 +1,293 @@
+import collections
+import os
+import queue
+import random
+import struct
+import threading
+import time
+
+from btdrv import *
+
+
+class EmuPipe:
+	def __init__(self, msg):
+		self.idx = msg.pipe_idx
+		self.ring_iova = msg.ring_iova
+		self.ring_count = msg.ring_count
+		self.ent_sz = TRANSFERHEADER_SZ + msg.foot_size*4
+		self.cr_idx = msg.completion_ring_index
+		self.doorbell = msg.doorbell_idx
+		self.virtual = msg.flags & 0x80 != 0
+		self.tail = 0
+		# virtual pipes: how many completions the host has asked for
+		self.credits = 0
+		# pipes that go to the host: completions waiting for credits/buffers
+		self.pending = collections.deque()
+		# ring pipes that go to the host: buffers posted by the host
+		self.posted = collections.deque()
+		self.next_msg_id = 0
+
+
+class EmuRing:
+	def __init__(self, iova, count, foot_size):
+		self.iova = iova
+		self.count = count
+		self.ent_sz = COMPLETIONHEADER_SZ + foot_size*4
+		self.foot_sz = foot_size*4
+
+
+# where traffic sent by the host comes back
+LOOPBACK = {
+	1: 2,	# HCI command -> command complete event
+	3: 4,	# SCO
+	5: 6,	# ACL
+}
+
+
+class EmuDevice:
+	"""
+	Stand-in for the chip that speaks the same ring protocol over an ordinary
+	anonymous mapping. HCI commands are answered with Command Complete, ACL and
+	SCO traffic is looped back to the host.
+	"""
+
+	boot_delay = 0
+
+	def __init__(self, name='emu', wake_delay=0.0005):
+		self.name = name
+		# how long unquiescing takes
+		self.wake_delay = wake_delay
+		self.asleep = False
+		self.sleeps = 0
+		# doorbells rung while quiesced, only looked at after waking up
+		self.deferred = set()
+		# stops looking at doorbells until the next reset, see hang()
+		self.hung = False
+		self.irqfd = os.eventfd(0, 0)
+		self.regs = {}
+		self.cfg = {}
+		self.dma_regions = []
+		self.ctx = None
+		self.pipes = {}
+		self.crs = {}
+
+		self.work = queue.SimpleQueue()
+		self.running = True
+		self.fwthread = threading.Thread(target=self.firmware, daemon=True)
+
+	def reset(self):
+		self.regs.clear()
+		# the rest of the state belongs to the firmware thread
+		self.work.put(('reset', 0))
+
+	def hang(self):
+		"""Simulate the firmware wedging: doorbells are ignored until the next reset"""
+		self.work.put(('hang', 0))
+
+	def barrier(self):
+		pass
+
+	def cfgread16(self, off):
+		return self.cfg.get(off, 0) & 0xffff
+
+	def cfgwrite16(self, off, val):
+		self.cfg[off] = val
+
+	def cfgread32(self, off):
+		return self.cfg.get(off, 0)
+
+	def cfgwrite32(self, off, val):
+		self.cfg[off] = val
+
+	def mmioread32(self, reg):
+		return self.regs.get(reg, 0)
+
+	def mmiowrite32(self, reg, val):
+		self.regs[reg] = val
+		self.work.put((reg, val))
+
+	def map_dma(self, mem, iova):
+		self.dma_regions.append((iova, len(mem), mem))
+
+	def enable_irq(self):
+		# called again after a reset
+		if not self.fwthread.is_alive():
+			self.fwthread.start()
+
+	def close(self):
+		self.running = False
+		self.work.put(None)
+
+	def dma(self, iova, sz):
+		for rgn_iova, rgn_sz, mem in self.dma_regions:
+			if rgn_iova <= iova and iova + sz <= rgn_iova + rgn_sz:
+				off = iova - rgn_iova
+				return memoryview(mem)[off:off+sz]
+		raise ValueError(f"{self.name}: DMA to unmapped iova {iova:016X}")
+
+	def get16(self, iova):
+		return struct.unpack("<H", self.dma(iova, 2))[0]
+
+	def set16(self, iova, val):
+		self.dma(iova, 2)[:] = struct.pack("<H", val)
+
+	def irq(self):
+		os.eventfd_write(self.irqfd, 1)
+
+	def firmware(self):
+		while self.running:
+			item = self.work.get()
+			if item is None:
+				break
+			reg, val = item
+
+			if reg == 'reset':
+				self.ctx = None
+				self.pipes.clear()
+				self.crs.clear()
+				self.asleep = False
+				self.deferred.clear()
+				self.hung = False
+			elif reg == 'hang':
+				self.hung = True
+			elif self.hung:
+				continue
+			elif reg == IMG_DOORBELL:
+				self.regs[BOOTSTAGE] = 2
+				self.irq()
+			elif reg == RTI_CONTROL:
+				if val == 2:
+					ctx_iova = self.regs.get(RTI_CONTEXT_LO, 0) | self.regs.get(RTI_CONTEXT_HI, 0) << 32
+					self.ctx = ContextStruct._make(struct.unpack(CONTEXTSTRUCT_STR, self.dma(ctx_iova, CONTEXTSTRUCT_SZ)))
+					self.pipes[0] = EmuPipe(make_openpipe(0, self.ctx.mtrOptFootSize, self.ctx.mtr, 0, 0)._replace(ring_count=self.ctx.mtrEntry))
+					self.crs[0] = EmuRing(self.ctx.mcr, self.ctx.mcrEntry, self.ctx.mcrOptFootSize)
+				self.regs[RTI_GET_STATUS] = val
+				self.irq()
+			elif reg == RTI_SLEEP_CONTROL:
+				if val == SLEEP_CONTROL_QUIESCE:
+					self.asleep = True
+					self.sleeps += 1
+				elif self.asleep:
+					time.sleep(self.wake_delay)
+					self.asleep = False
+					for db in sorted(self.deferred):
+						self.doorbell(db)
+					self.deferred.clear()
+			elif reg == DOORBELL_05:
+				self.doorbell((val >> 8) & 0xff)
+			elif reg == DOORBELL_6:
+				if self.ctx is not None:
+					self.doorbell(6)
+
+	def doorbell(self, db):
+		if self.asleep:
+			self.deferred.add(db)
+			return
+		for pipe in list(self.pipes.values()):
+			if pipe.doorbell == db:
+				self.process_pipe(pipe)
+
+	def process_pipe(self, pipe):
+		head = self.get16(self.ctx.trHIA + pipe.idx*2)
+		if pipe.virtual:
+			pipe.credits += (head - pipe.tail) % pipe.ring_count
+			pipe.tail = head
+			self.set16(self.ctx.trTIA + pipe.idx*2, pipe.tail)
+			self.flush(pipe)
+			return
+
+		done = []
+		while pipe.tail != head:
+			ent = self.dma(pipe.ring_iova + pipe.tail*pipe.ent_sz, pipe.ent_sz)
+			hdr = TransferHeader._make(struct.unpack(TRANSFERHEADER_STR, ent[:TRANSFERHEADER_SZ]))
+			pipe.tail = (pipe.tail + 1) % pipe.ring_count
+			self.set16(self.ctx.trTIA + pipe.idx*2, pipe.tail)
+
+			if pipe.idx in LOOPBACK or pipe.idx == 0:
+				if hdr.flags & 2:
+					payload = bytes(ent[TRANSFERHEADER_SZ:TRANSFERHEADER_SZ+hdr.len_])
+				elif hdr.flags & 1:
+					payload = bytes(self.dma(hdr.buf_iova, hdr.len_))
+				else:
+					payload = b''
+				done.append(hdr.msg_id)
+				self.handle(pipe, payload)
+			else:
+				# buffer posted for device->host traffic
+				pipe.posted.append(hdr)
+				self.flush(pipe)
+
+		if self.ctx.res_inPlaceComp_oOOComp & CTX_OOO_COMP:
+			random.shuffle(done)
+		for msg_id in done:
+			self.complete(pipe, msg_id)
+
+	def fw_log(self, text):
+		pipe = self.pipes.get(8)
+		if pipe is not None:
+			pipe.pending.append(text.encode() + b'\x00')
+			self.flush(pipe)
+
+	def handle(self, pipe, payload):
+		if pipe.idx == 0:
+			msg_type = payload[0]
+			if msg_type == 1:
+				msg = OpenPipeMessage._make(struct.unpack(OPENPIPE_STR, payload))
+				self.pipes[msg.pipe_idx] = EmuPipe(msg)
+				self.fw_log(f"pipe {msg.pipe_idx} open, cr {msg.completion_ring_index} db {msg.doorbell_idx}")
+			elif msg_type == 2:
+				msg = OpenCompletionRingMessage._make(struct.unpack(OPENCOMPLETIONRING_STR, payload))
+				self.crs[msg.cr_idx] = EmuRing(msg.ring_iova, msg.ring_count, msg.foot_size)
+			return
+
+		out = self.pipes.get(LOOPBACK[pipe.idx])
+		if out is None:
+			return
+		if pipe.idx == 1:
+			self.fw_log(f"hci cmd {payload[0] | payload[1] << 8:04x}")
+			# Command Complete, status success
+			payload = bytes([0x0e, 0x04, 0x01, payload[0], payload[1], 0x00])
+		out.pending.append(payload)
+		self.flush(out)
+
+	def flush(self, pipe):
+		while pipe.pending:
+			if pipe.virtual:
+				if pipe.credits == 0:
+					return
+				pipe.credits -= 1
+				# XXX the real msg_id for virtual pipes is unknown
+				msg_id = pipe.next_msg_id
+				pipe.next_msg_id = (msg_id + 1) % pipe.ring_count
+				self.complete(pipe, msg_id, pipe.pending.popleft())
+			else:
+				if not pipe.posted:
+					return
+				hdr = pipe.posted.popleft()
+				payload = pipe.pending.popleft()[:hdr.len_]
+				self.dma(hdr.buf_iova, len(payload))[:] = payload
+				self.complete(pipe, hdr.msg_id, payload, inline=False)
+
+	def complete(self, pipe, msg_id, payload=b'', inline=True):
+		cr_idx = pipe.cr_idx
+		cr = self.crs[cr_idx]
+		head = self.get16(self.ctx.crHIA + cr_idx*2)
+		while (head + 1) % cr.count == self.get16(self.ctx.crTIA + cr_idx*2):
+			# ring full, wait for the host to catch up
+			if not self.running:
+				return
+			os.sched_yield()
+
+		flags = 0
+		if payload:
+			if inline:
+				assert len(payload) <= cr.foot_sz
+				flags = 2
+			else:
+				flags = 1
+		ent = self.dma(cr.iova + head*cr.ent_sz, cr.ent_sz)
+		ent[:COMPLETIONHEADER_SZ] = struct.pack(COMPLETIONHEADER_STR, flags, b'\x04', pipe.idx, msg_id, len(payload), b'\x00'*6)
+		if flags & 2:
+			ent[COMPLETIONHEADER_SZ:COMPLETIONHEADER_SZ+len(payload)] = payload
+		self.set16(self.ctx.crHIA + cr_idx*2, (head + 1) % cr.count)
+		self.irq()
@@ -0,0 +1,107 @@
+import collections
+import os
+import threading
+import time
+
+from util import *
+
+
+# records held in memory waiting for the writer before we start dropping
+MAX_QUEUED = 4096
+
+
+class RotatingLog:
+	"""path, path.1, ... path.N, rolled over once path reaches max_bytes"""
+
+	def __init__(self, path, max_bytes, backups):
+		self.path = path
+		self.max_bytes = max_bytes
+		self.backups = backups
+		self.f = open(path, 'a')
+		self.size = self.f.tell()
+
+	def rotate(self):
+		self.f.close()
+		for i in range(self.backups - 1, 0, -1):
+			if os.path.exists(f"{self.path}.{i}"):
+				os.replace(f"{self.path}.{i}", f"{self.path}.{i+1}")
+		if self.backups:
+			os.replace(self.path, f"{self.path}.1")
+		else:
+			os.unlink(self.path)
+		self.f = open(self.path, 'w')
+		self.size = 0
+
+	def write(self, line):
+		if self.size + len(line) > self.max_bytes and self.size:
+			self.rotate()
+		self.f.write(line)
+		self.size += len(line)
+
+	def flush(self):
+		self.f.flush()
+
+	def close(self):
+		self.f.close()
+
+
+def decode_record(payload):
+	"""
+	XXX the record format is unknown. Text gets split into lines, anything
+	that doesn't look like text is hexdumped.
+	"""
+	text = payload.rstrip(b'\x00')
+	if text and all(0x20 <= c < 0x7f or c in b'\t\r\n\x00' for c in text):
+		return [line for line in text.replace(b'\x00', b'\n').decode().splitlines() if line]
+	lines = []
+	chexdump(payload, print_fn=lines.append)
+	return lines
+
+
+class FirmwareLog:
+	"""
+	Consumer for the firmware debug pipe. The interrupt thread only appends the
+	raw record to a bounded queue, decoding and file I/O happen on our own
+	thread, so a slow disk drops log records instead of stalling completions.
+	"""
+
+	def __init__(self, path, max_bytes, backups, name=''):
+		self.out = RotatingLog(path, max_bytes, backups)
+		self.name = name
+		self.queue = collections.deque()
+		self.dropped = 0
+		self.records = 0
+		self.wakeup = threading.Event()
+		self.running = True
+		self.thread = threading.Thread(target=self.writer, daemon=True)
+		self.thread.start()
+
+	def push(self, payload):
+		# called from the interrupt thread, must not block
+		if len(self.queue) >= MAX_QUEUED:
+			self.dropped += 1
+			return
+		self.queue.append((time.time(), payload))
+		self.wakeup.set()
+
+	def writer(self):
+		reported_drops = 0
+		while self.running or self.queue:
+			self.wakeup.wait(0.5)
+			self.wakeup.clear()
+			while self.queue:
+				ts, payload = self.queue.popleft()
+				self.records += 1
+				stamp = time.strftime('%H:%M:%S', time.localtime(ts)) + f".{int(ts * 1e6) % 1000000:06d}"
+				for line in decode_record(payload):
+					self.out.write(f"{stamp} {line}\n")
+			if self.dropped != reported_drops:
+				self.out.write(f"*** {self.dropped - reported_drops} firmware log records dropped\n")
+				reported_drops = self.dropped
+			self.out.flush()
+
+	def close(self):
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()
+		self.out.close()
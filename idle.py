@@ -0,0 +1,116 @@
+from collections import deque
+import threading
+import time
+
+from util import percentile
+
+# wake latency percentiles are over the most recent wakes only
+WAKE_WINDOW = 1024
+
+
+class IdleManager:
+	"""
+	Quiesces the device once no ring has moved for `timeout` seconds and
+	unquiesces it again on the next doorbell. The timeout is the knob: shorter
+	sleeps more, longer keeps the first packet after a pause fast.
+
+	Wake latency is measured from the unquiesce write to the first interrupt
+	after it, i.e. what the packet that woke the device paid on top of its
+	normal round trip, over the last WAKE_WINDOW wakes.
+
+	The doorbell path doesn't take the lock unless the device is asleep: it
+	stores `last` and then reads `asleep`, the idle thread stores `asleep` and
+	then re-reads `last`, so one of them always sees the other.
+	"""
+
+	def __init__(self, drv, timeout, log=print):
+		self.drv = drv
+		self.timeout_ns = int(timeout * 1e9)
+		self.log = log
+		self.lock = threading.Lock()
+		self.wakeup = threading.Event()
+		self.last = time.monotonic_ns()
+		self.asleep = False
+		self.wake_start = None
+
+		self.sleeps = 0
+		self.asleep_ns = 0
+		self.slept_at = 0
+		self.wakes = 0
+		self.wake_latencies = deque(maxlen=WAKE_WINDOW)
+
+		self.running = True
+		self.thread = threading.Thread(target=self.idle_thread, daemon=True)
+		self.thread.start()
+
+	def kick(self):
+		# called before every doorbell
+		self.last = time.monotonic_ns()
+		if self.asleep:
+			with self.lock:
+				if self.asleep:
+					self.wake_start = time.perf_counter_ns()
+					self.drv.unquiesce()
+					self.asleep = False
+					self.asleep_ns += time.monotonic_ns() - self.slept_at
+					self.wakeup.set()
+
+	def interrupt(self):
+		# called from the interrupt thread
+		self.last = time.monotonic_ns()
+		if self.wake_start is not None:
+			self.wake_latencies.append(time.perf_counter_ns() - self.wake_start)
+			self.wakes += 1
+			self.wake_start = None
+
+	def idle_thread(self):
+		while self.running:
+			if self.asleep:
+				self.wakeup.wait()
+				self.wakeup.clear()
+				continue
+
+			last = self.last
+			remaining = last + self.timeout_ns - time.monotonic_ns()
+			if remaining > 0:
+				# a kick that lost the race with quiesce() leaves this set
+				self.wakeup.clear()
+				if self.running:
+					self.wakeup.wait(remaining / 1e9)
+				continue
+
+			with self.lock:
+				if not self.running or not self.drv.rings_idle():
+					# something still in flight, look again after another timeout
+					self.last = time.monotonic_ns()
+					continue
+				self.asleep = True
+				if self.last != last:
+					# raced with a doorbell
+					self.asleep = False
+					continue
+				self.drv.quiesce()
+				self.sleeps += 1
+				self.slept_at = time.monotonic_ns()
+
+	def stats(self):
+		asleep_ns = self.asleep_ns
+		if self.asleep:
+			asleep_ns += time.monotonic_ns() - self.slept_at
+		return {
+			'state': 'asleep' if self.asleep else 'awake',
+			'sleeps': self.sleeps,
+			'wakes': self.wakes,
+			'asleep_s': asleep_ns / 1e9,
+			'wake_p50_us': percentile(self.wake_latencies, 50) / 1000,
+			'wake_p99_us': percentile(self.wake_latencies, 99) / 1000,
+		}
+
+	def report(self):
+		s = self.stats()
+		self.log(f"idle: {s['sleeps']} sleeps, {s['asleep_s']:.3f} s asleep, wake latency p50 {s['wake_p50_us']:.1f} us p99 {s['wake_p99_us']:.1f} us")
+
+	def close(self):
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()
@@ -0,0 +1,272 @@
+#!/usr/bin/env python3
+
+"""
+Synthetic HCI load generator. Stands in for the VHCI endpoint, pushes a mix
+of HCI commands, ACL and SCO through the driver's 0x01/0x02/0x03 dispatch into
+pipes 1/5/3 and times each packet until it comes back through the emulated
+device's loopback. The offered load is stepped up until the driver saturates.
+
+	python3 loadgen.py --acl-links 8 --sco-channels 2 --rates 1000,2000,5000,10000
+
+--check-recovery hangs the emulated firmware instead, pushes a burst into the
+stuck rings and lets the watchdog reset it, then checks nothing was lost and
+no TX buffer leaked.
+
+	python3 loadgen.py --check-recovery 5 --acl-sizes 27,1017
+"""
+
+import argparse
+import json
+import random
+import socket
+import struct
+import sys
+import threading
+import time
+
+from bench import make_driver
+from util import percentile
+
+
+HCI_VENDOR_OGF = 0x3f
+
+
+class LoadGen:
+	def __init__(self, drv, mix, acl_links, sco_channels, acl_sizes, sco_size):
+		self.drv = drv
+		self.kinds = [kind for kind, weight in mix.items() for _ in range(weight)]
+		self.acl_links = acl_links
+		self.sco_channels = sco_channels
+		self.acl_sizes = acl_sizes
+		self.sco_size = sco_size
+
+		self.ours, self.theirs = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+		drv.vhci_fd = self.theirs.fileno()
+		self.vhci_thread = threading.Thread(target=drv.run_vhci, daemon=True)
+		self.vhci_thread.start()
+
+		self.lock = threading.Lock()
+		# (kind, seq) -> send time
+		self.outstanding = {}
+		self.latencies = {'hci': [], 'acl': [], 'sco': []}
+		self.rx_bytes = 0
+		self.running = True
+		self.rx_thread = threading.Thread(target=self.receiver, daemon=True)
+		self.rx_thread.start()
+
+	def make_packet(self, kind, seq):
+		if kind == 'hci':
+			# vendor opcode, the low bits tell outstanding commands apart
+			opcode = HCI_VENDOR_OGF << 10 | (seq & 0x3ff)
+			return b'\x01' + struct.pack("<HB", opcode, 0), ('hci', opcode)
+		elif kind == 'acl':
+			size = random.choice(self.acl_sizes)
+			data = struct.pack("<I", seq) + bytes(size - 4)
+			return b'\x02' + struct.pack("<HH", seq % self.acl_links, size) + data, ('acl', seq)
+		elif kind == 'sco':
+			data = struct.pack("<I", seq) + bytes(self.sco_size - 4)
+			return b'\x03' + struct.pack("<HB", seq % self.sco_channels, self.sco_size) + data, ('sco', seq)
+		assert False
+
+	def receiver(self):
+		now = time.perf_counter_ns
+		while self.running:
+			try:
+				pkt = self.ours.recv(4096)
+			except OSError:
+				break
+			if not pkt:
+				break
+			t = now()
+			if pkt[0] == 0x04 and pkt[1] == 0x0e:
+				key = ('hci', struct.unpack_from("<H", pkt, 4)[0])
+			elif pkt[0] == 0x02:
+				key = ('acl', struct.unpack_from("<I", pkt, 5)[0])
+			elif pkt[0] == 0x03:
+				key = ('sco', struct.unpack_from("<I", pkt, 4)[0])
+			else:
+				continue
+			with self.lock:
+				t0 = self.outstanding.pop(key, None)
+				if t0 is not None:
+					self.latencies[key[0]].append(t - t0)
+					self.rx_bytes += len(pkt)
+
+	def run_step(self, rate, duration, drain=1.0):
+		with self.lock:
+			self.outstanding.clear()
+			self.latencies = {'hci': [], 'acl': [], 'sco': []}
+			self.rx_bytes = 0
+
+		now = time.perf_counter_ns
+		interval = 1e9 / rate
+		start = now()
+		end = start + duration * 1e9
+		next_send = start
+		seq = 0
+		while True:
+			t = now()
+			if t >= end:
+				break
+			if t < next_send:
+				if next_send - t > 200000:
+					time.sleep((next_send - t) / 2e9)
+				continue
+			kind = self.kinds[seq % len(self.kinds)]
+			with self.lock:
+				if kind == 'hci' and ('hci', HCI_VENDOR_OGF << 10 | (seq & 0x3ff)) in self.outstanding:
+					# would alias an outstanding command
+					kind = 'acl'
+			pkt, key = self.make_packet(kind, seq)
+			with self.lock:
+				self.outstanding[key] = now()
+			self.ours.send(pkt)
+			seq += 1
+			next_send += interval
+		sent_time = (now() - start) / 1e9
+
+		drain_end = time.monotonic() + drain
+		while self.outstanding and time.monotonic() < drain_end:
+			time.sleep(0.01)
+
+		with self.lock:
+			lost = len(self.outstanding)
+			latencies = self.latencies
+			all_lat = [l for values in latencies.values() for l in values]
+			rx_bytes = self.rx_bytes
+
+		result = {
+			'offered_pps': rate,
+			'sent_pps': seq / sent_time,
+			'completed_pps': len(all_lat) / sent_time,
+			'rx_mbps': rx_bytes * 8 / sent_time / 1e6,
+			'lost': lost,
+		}
+		for kind, values in list(latencies.items()) + [('all', all_lat)]:
+			if values:
+				result[kind] = {
+					'count': len(values),
+					'p50_us': percentile(values, 50) / 1000,
+					'p99_us': percentile(values, 99) / 1000,
+					'p999_us': percentile(values, 99.9) / 1000,
+				}
+		return result
+
+	def check_recovery(self, rounds, burst, drain=5.0):
+		drv = self.drv
+		failures = 0
+		seq = 0
+		for i in range(rounds):
+			with self.lock:
+				self.outstanding.clear()
+			recoveries = drv.recoveries
+			drv.hw.hang()
+			for _ in range(burst):
+				kind = self.kinds[seq % len(self.kinds)]
+				with self.lock:
+					if kind == 'hci' and ('hci', HCI_VENDOR_OGF << 10 | (seq & 0x3ff)) in self.outstanding:
+						kind = 'acl'
+				pkt, key = self.make_packet(kind, seq)
+				with self.lock:
+					self.outstanding[key] = time.perf_counter_ns()
+				# blocks once the rings are full, until the watchdog steps in
+				self.ours.send(pkt)
+				seq += 1
+
+			# looped back packets can beat the completions of their TX buffers
+			drain_end = time.monotonic() + drain
+			while (self.outstanding or any(drv.tx_inflight) or drv.recoveries == recoveries) and time.monotonic() < drain_end:
+				time.sleep(0.01)
+
+			with self.lock:
+				lost = len(self.outstanding)
+			leaked = {tag: count for tag, (count, _) in drv.arena.outstanding().items() if tag.startswith('pipe') and tag.endswith(' tx')}
+			ok = drv.recoveries > recoveries and not lost and not leaked
+			if not ok:
+				failures += 1
+			print(f"round {i}: {drv.recoveries - recoveries} recoveries, {lost} of {burst} lost, leaked {leaked or 'nothing'}{'' if ok else '  FAIL'}")
+		return failures
+
+	def close(self):
+		self.running = False
+		self.drv.vhci_fd = None
+		self.theirs.shutdown(socket.SHUT_RDWR)
+		self.ours.shutdown(socket.SHUT_RDWR)
+		self.vhci_thread.join()
+		self.rx_thread.join()
+		self.ours.close()
+		self.theirs.close()
+
+
+def parse_mix(s):
+	mix = {}
+	for part in s.split(','):
+		kind, weight = part.split('=')
+		assert kind in ('hci', 'acl', 'sco'), f"unknown traffic kind {kind}"
+		mix[kind] = int(weight)
+	return mix
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+	parser.add_argument('--rates', default='500,1000,2000,5000,10000,20000', help="offered packets/s per step (default: %(default)s)")
+	parser.add_argument('--duration', type=float, default=2.0, help="seconds per step")
+	parser.add_argument('--mix', type=parse_mix, default='hci=1,acl=8,sco=2', help="relative weights (default: %(default)s)")
+	parser.add_argument('--acl-links', type=int, default=4, help="number of ACL connection handles")
+	parser.add_argument('--sco-channels', type=int, default=1, help="number of SCO connection handles")
+	parser.add_argument('--acl-sizes', default='27,251,1000', help="ACL payload sizes to pick from (default: %(default)s)")
+	parser.add_argument('--sco-size', type=int, default=60, help="SCO payload size")
+	parser.add_argument('--stop-at-saturation', action='store_true', help="stop once less than 90%% of the offered load completes")
+	parser.add_argument('--submit-workers', action='store_true', help="send through per-pipe ring owner threads")
+	parser.add_argument('--pin-cpus', help="CPUs to pin the ring owner threads to, e.g. 2,3")
+	parser.add_argument('--check-recovery', type=int, metavar='ROUNDS', help="hang the firmware ROUNDS times under a burst and check the watchdog recovers everything")
+	parser.add_argument('--burst', type=int, default=300, help="packets sent per --check-recovery round")
+	parser.add_argument('-o', '--output', help="write results as JSON")
+	args = parser.parse_args()
+
+	acl_sizes = [int(size) for size in args.acl_sizes.split(',')]
+	assert max(acl_sizes) <= 1024 - 5, "ACL packets must fit in one VHCI read"
+
+	cpus = [int(cpu) for cpu in args.pin_cpus.split(',')] if args.pin_cpus else None
+	kw = {'stall_timeout': 0.2} if args.check_recovery else {}
+	drv = make_driver('loadgen', submit_workers=args.submit_workers, submit_cpus=cpus, **kw)
+	gen = LoadGen(drv, args.mix, args.acl_links, args.sco_channels, acl_sizes, args.sco_size)
+
+	if args.check_recovery:
+		failures = gen.check_recovery(args.check_recovery, args.burst)
+		gen.close()
+		drv.close()
+		sys.exit(1 if failures else 0)
+
+	steps = []
+	print(f"{'offered':>9} {'sent':>9} {'done':>9} {'Mbit/s':>7} {'lost':>5}  {'p50 us':>8} {'p99 us':>8} {'p999 us':>8}")
+	for rate in [int(rate) for rate in args.rates.split(',')]:
+		result = gen.run_step(rate, args.duration)
+		steps.append(result)
+		lat = result.get('all', {'p50_us': 0, 'p99_us': 0, 'p999_us': 0})
+		print(f"{rate:9} {result['sent_pps']:9.0f} {result['completed_pps']:9.0f} {result['rx_mbps']:7.2f} {result['lost']:5}  {lat['p50_us']:8.1f} {lat['p99_us']:8.1f} {lat['p999_us']:8.1f}")
+		if args.stop_at_saturation and result['completed_pps'] < 0.9 * rate:
+			print("saturated")
+			break
+
+	gen.close()
+	drv.close()
+
+	if args.output:
+		with open(args.output, 'w') as f:
+			json.dump({
+				'config': {
+					'mix': args.mix,
+					'acl_links': args.acl_links,
+					'sco_channels': args.sco_channels,
+					'acl_sizes': acl_sizes,
+					'sco_size': args.sco_size,
+					'duration': args.duration,
+					'submit_workers': args.submit_workers,
+				},
+				'steps': steps,
+			}, f, indent=1)
+
+
+if __name__ == '__main__':
+	main()
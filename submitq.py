@@ -0,0 +1,145 @@
+import os
+import threading
+
+
+class DeviceTimeout(Exception):
+	pass
+
+
+class RingReset(Exception):
+	"""A send waiting on a full ring got interrupted by recovery, retry it afterwards"""
+	pass
+
+
+class SubmitQueue:
+	"""
+	Fixed size single producer/single consumer ring. The producer only ever
+	writes `head` and the consumer only ever writes `tail`, so neither side
+	needs a lock.
+	"""
+
+	def __init__(self, size=256):
+		assert size & (size - 1) == 0
+		self.slots = [None] * size
+		self.mask = size - 1
+		self.head = 0
+		self.tail = 0
+
+	def __len__(self):
+		return self.head - self.tail
+
+	def put(self, item):
+		head = self.head
+		if head - self.tail > self.mask:
+			return False
+		self.slots[head & self.mask] = item
+		self.head = head + 1
+		return True
+
+	def peek(self, max_items):
+		tail = self.tail
+		n = min(self.head - tail, max_items)
+		return [self.slots[(tail + i) & self.mask] for i in range(n)]
+
+	def consume(self, n):
+		tail = self.tail
+		for i in range(n):
+			self.slots[(tail + i) & self.mask] = None
+		self.tail = tail + n
+
+	def discard(self):
+		# consumer side only
+		self.consume(self.head - self.tail)
+
+
+class PipeWorker:
+	"""
+	Owns one pipe's transfer ring: everything sent on the pipe goes through
+	its queue, and it writes whole batches into the ring before ringing the
+	doorbell once. Virtual pipes queue None, each one is a boop.
+
+	`lock` is held while touching the ring so recovery can park the worker.
+	"""
+
+	def __init__(self, drv, pipe, size=256, batch=32, cpu=None):
+		self.drv = drv
+		self.pipe = pipe
+		self.batch = batch
+		self.cpu = cpu
+		self.virtual = drv.transfer_ring_infos[pipe][0] is None
+		self.q = SubmitQueue(size)
+		self.lock = threading.Lock()
+		self.evfd = os.eventfd(0, 0)
+		self.sleeping = False
+		self.running = True
+
+		self.batches = 0
+		self.items = 0
+		self.max_batch = 0
+
+		self.thread = threading.Thread(target=self.run, name=f"{drv.cfg.name} pipe {pipe}", daemon=True)
+		self.thread.start()
+
+	def put(self, item):
+		while not self.q.put(item):
+			# full, the worker is behind
+			if self.drv.recovering or not self.drv.recovered.is_set():
+				raise RingReset()
+			os.sched_yield()
+		if self.sleeping:
+			os.eventfd_write(self.evfd, 1)
+
+	def submit(self, items):
+		drv = self.drv
+		if self.virtual:
+			drv.boop_cr(self.pipe, len(items))
+			return len(items)
+
+		done = 0
+		try:
+			for item in items:
+				drv.submit(self.pipe, item, False, False)
+				done += 1
+		except (RingReset, DeviceTimeout):
+			pass
+		if done and not drv.recovering:
+			drv.ring_doorbell(self.pipe, drv.get_tr_head(self.pipe))
+		return done
+
+	def run(self):
+		drv = self.drv
+		if self.cpu is not None:
+			os.sched_setaffinity(0, {self.cpu})
+		while self.running and drv.running:
+			if not drv.recovered.is_set():
+				# the rings are being reset, or are gone until a recovery works
+				drv.recovered.wait()
+				continue
+
+			with self.lock:
+				# checked under the lock, recovery may have emptied the queue or failed
+				items = self.q.peek(self.batch) if drv.recovered.is_set() else None
+				if items:
+					done = self.submit(items)
+					self.q.consume(done)
+
+			if items is None:
+				continue
+			if not items:
+				self.sleeping = True
+				# recheck, a put may have seen sleeping == False just before
+				if not len(self.q) and self.running:
+					os.eventfd_read(self.evfd)
+				self.sleeping = False
+				continue
+
+			self.batches += 1
+			self.items += done
+			if done > self.max_batch:
+				self.max_batch = done
+
+	def close(self):
+		self.running = False
+		os.eventfd_write(self.evfd, 1)
+		self.thread.join()
+		os.close(self.evfd)
@@ -1,988 +1,133 @@
 #!/usr/bin/env python3
 
-import array
-from collections import namedtuple
-from ctypes import *
-from fcntl import ioctl
-import itertools
-import mmap
-import os
-import struct
-import time
+import argparse
+import json
+import signal
 import threading
 
+from btdrv import *
 
-DO_VHCI = True
 
+def load_config(path):
+	"""
+	{"defaults": {...}, "controllers": [{"bdf": "0000:01:00.1", ...}, ...]}
 
-def _ascii(s):
-    s2 = ""
-    for c in s:
-        if c < 0x20 or c > 0x7e:
-            s2 += "."
-        else:
-            s2 += chr(c)
-    return s2
+	Any ControllerConfig field can be set in either place. Controllers listed
+	without a group get it filled in from sysfs.
+	"""
+	with open(path) as f:
+		config = json.load(f)
+	defaults = config.get('defaults', {})
+	return [dict(defaults, **ctrl) for ctrl in config.get('controllers', [])]
 
-def hexdump(s, sep=" "):
-    return sep.join(["%02x"%x for x in s])
 
-def chexdump(s, st=0, abbreviate=True, indent="", print_fn=print):
-    last = None
-    skip = False
-    for i in range(0,len(s),16):
-        val = s[i:i+16]
-        if val == last and abbreviate:
-            if not skip:
-                print_fn(indent+"%08x  *" % (i + st))
-                skip = True
-        else:
-            print_fn(indent+"%08x  %s  %s  |%s|" % (
-                  i + st,
-                  hexdump(val[:8], ' ').ljust(23),
-                  hexdump(val[8:], ' ').ljust(23),
-                  _ascii(val).ljust(16)))
-            last = val
-            skip = False
+def make_configs(args):
+	from vfio import find_controllers
 
-
-VFIO_IOCTL_BASE = 0x3B64
-VFIO_GET_API_VERSION = VFIO_IOCTL_BASE + 0
-VFIO_CHECK_EXTENSION = VFIO_IOCTL_BASE + 1
-VFIO_SET_IOMMU = VFIO_IOCTL_BASE + 2
-VFIO_GROUP_GET_STATUS = VFIO_IOCTL_BASE + 3
-VFIO_GROUP_SET_CONTAINER = VFIO_IOCTL_BASE + 4
-VFIO_GROUP_GET_DEVICE_FD = VFIO_IOCTL_BASE + 6
-VFIO_DEVICE_GET_INFO = VFIO_IOCTL_BASE + 7
-VFIO_DEVICE_GET_REGION_INFO = VFIO_IOCTL_BASE + 8
-VFIO_DEVICE_GET_IRQ_INFO = VFIO_IOCTL_BASE + 9
-VFIO_DEVICE_SET_IRQS = VFIO_IOCTL_BASE + 10
-VFIO_DEVICE_RESET = VFIO_IOCTL_BASE + 11
-VFIO_IOMMU_GET_INFO = VFIO_IOCTL_BASE + 12
-VFIO_IOMMU_MAP_DMA = VFIO_IOCTL_BASE + 13
-
-VFIO_TYPE1_IOMMU = 1
-
-container = os.open('/dev/vfio/vfio', os.O_RDWR)
-print(f"container fd = {container}")
-
-api_ver = ioctl(container, VFIO_GET_API_VERSION, 0)
-print(f"api_ver = {api_ver}")
-assert api_ver == 0
-
-check_ext = ioctl(container, VFIO_CHECK_EXTENSION, VFIO_TYPE1_IOMMU)
-print(f"iommu extension {check_ext}")
-assert check_ext != 0
-
-group = os.open('/dev/vfio/8', os.O_RDWR)
-print(f"group fd = {group}")
-
-group_status = ioctl(group, VFIO_GROUP_GET_STATUS, struct.pack("<II", 8, 0))
-print(group_status)
-_, flags = struct.unpack("<II", group_status)
-print(f"group flags = {flags}")
-assert flags & 1 != 0
-
-ioctl(group, VFIO_GROUP_SET_CONTAINER, struct.pack("<I", container))
-ret = ioctl(container, VFIO_SET_IOMMU, VFIO_TYPE1_IOMMU)
-assert ret == 0
-
-iommu_info = ioctl(container, VFIO_IOMMU_GET_INFO, struct.pack("<IIQI", 20, 0, 0, 0))
-# print(iommu_info)
-argsz, flags, iova_pgsizes, cap_offset = struct.unpack("<IIQI", iommu_info)
-print("iommu info", argsz, flags, iova_pgsizes, cap_offset)
-
-device = ioctl(group, VFIO_GROUP_GET_DEVICE_FD, array.array('b', b"0000:01:00.1"))
-print(f"device fd = {device}")
-
-#wifi_device = ioctl(group, VFIO_GROUP_GET_DEVICE_FD, array.array('b', b"0000:01:00.0"))
-#print(f"wifi device fd = {wifi_device}")
-
-device_info = ioctl(device, VFIO_DEVICE_GET_INFO, struct.pack("<IIIII", 20, 0, 0, 0, 0))
-argsz, flags, num_regions, num_irqs, cap_offset = struct.unpack("<IIIII", device_info)
-print("device info", argsz, flags, num_regions, num_irqs, cap_offset)
-
-for rgn in range(num_regions):
-    try:
-        region_info = ioctl(device, VFIO_DEVICE_GET_REGION_INFO, struct.pack("<IIIIQQ", 32, 0, rgn, 0, 0, 0))
-        argsz, flags, index, cap_offset, size, offset = struct.unpack("<IIIIQQ", region_info)
-        print(f"region {index} argsz {argsz} flags {flags} cap_offset {cap_offset} size {size:016X} offset {offset:016X}")
-
-        if index == 0:
-            bar0_sz = size
-            bar0_off = offset
-
-        if index == 2:
-            bar1_sz = size
-            bar1_off = offset
-
-        if index == 7:
-            cfg_sz = size
-            cfg_off = offset
-
-    except OSError as e:
-        print(e)
-
-for irq in range(num_irqs):
-    irq_info = ioctl(device, VFIO_DEVICE_GET_IRQ_INFO, struct.pack("<IIII", 16, 0, irq, 0))
-    argsz, flags, index, count = struct.unpack("<IIII", irq_info)
-    print(f"irq {index} argsz {argsz} flags {flags} count {count}")
-
-#bar0 = mmap.mmap(device, bar0_sz, offset=bar0_off)
-#print(bar0)
-#bar1 = mmap.mmap(device, bar1_sz, offset=bar1_off)
-#print(bar1)
-
-#def read32(bar, addr):
-#    return struct.unpack("<I", bar[addr:addr+4])[0]
-
-#def write32(bar, addr, val):
-#    bar[addr:addr+4] = struct.pack("<I", val)
-
-libc = CDLL('libc.so.6')
-libglue = CDLL('./glue.so')
-
-libc_mmap = libc.mmap
-libc_mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_int, c_longlong]
-libc_mmap.restype = c_void_p
-
-# eww
-mmioread32 = libglue.read32
-mmioread32.argtypes = [c_void_p]
-mmioread32.restype = c_uint
-
-mmiowrite32 = libglue.write32
-mmiowrite32.argtypes = [c_void_p, c_uint]
-mmiowrite32.restype = None
-
-barrier = libglue.barrier
-barrier.argtypes = []
-barrier.restype = None
-
-def cfgread16(off):
-    return struct.unpack("<H", os.pread(device, 2, cfg_off+off))[0]
-
-def cfgwrite16(off, val):
-    os.pwrite(device, struct.pack("<H", val), cfg_off+off)
-
-def cfgread32(off):
-    return struct.unpack("<I", os.pread(device, 4, cfg_off+off))[0]
-
-def cfgwrite32(off, val):
-    os.pwrite(device, struct.pack("<I", val), cfg_off+off)
-
-ioctl(device, VFIO_DEVICE_RESET, "")
-
-bar0 = libc_mmap(None, bar0_sz, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_SHARED, device, bar0_off)
-print(f"bar0 mapped at {bar0:016X}")
-bar1 = libc_mmap(None, bar1_sz, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_SHARED, device, bar1_off)
-print(f"bar1 mapped at {bar1:016X}")
-
-# bus master
-cfgwrite16(4, cfgread16(4) | 0x4)
-
-cfgwrite32(0x80, 0x18002000)
-cfgwrite32(0x70, 0x18109000)
-cfgwrite32(0x74, 0x18011000)
-cfgwrite32(0x78, 0x18106000)
-cfgwrite32(0x84, 0x19000000)
-
-reset_thing = cfgread32(0x88)
-print(f"reset thing {reset_thing:08X}")
-if reset_thing & 0x80000 == 0:
-    reset_thing &= 0xfff6ffff
-cfgwrite32(0x88, reset_thing | 0x10000)
-
-# dunno how much we need or anything
-# dunno if dart limit is lower limit of iova or size limit
-IOVA_START = 0x2000000
-SHARED_MEM_SZ = 0x2000000
-
-mapped_memory = mmap.mmap(-1, SHARED_MEM_SZ, flags=mmap.MAP_PRIVATE | mmap.MAP_ANONYMOUS, prot=mmap.PROT_READ | mmap.PROT_WRITE)
-mapped_memory_addr = addressof(c_char.from_buffer(mapped_memory))
-print(f"memory region at {mapped_memory_addr:016X}")
-ioctl(container, VFIO_IOMMU_MAP_DMA, struct.pack("<IIQQQ", 32, 3, mapped_memory_addr, IOVA_START, SHARED_MEM_SZ))
-
-REG_0 = bar1 + 0x20044c
-RTI_GET_CAPABILITY = bar1 + 0x200450
-BOOTSTAGE = bar1 + 0x200454
-BAR1_IMG_ADDR_LO = bar1 + 0x200478
-BAR1_IMG_ADDR_HI = bar1 + 0x20047c
-BAR1_IMG_SZ = bar1 + 0x200480
-BTI_EXIT_CODE_RTI_IMG_RESPONSE = bar1 + 0x200488
-REG_7 = bar1 + 0x200464
-RTI_GET_STATUS = bar1 + 0x20045c
-RTI_CONTEXT_LO = bar1 + 0x20048c
-RTI_CONTEXT_HI = bar1 + 0x200490
-RTI_WINDOW_LO = bar1 + 0x200494
-RTI_WINDOW_HI = bar1 + 0x200498
-RTI_WINDOW_SZ = bar1 + 0x20049c
-REG_14 = bar1 + 0x20054c
-IMG_DOORBELL = bar0 + 0x140
-RTI_CONTROL = bar0 + 0x144
-RTI_SLEEP_CONTROL = bar0 + 0x150
-CHIPCOMMON_CHIP_STATUS = bar0 + 0x302c
-DOORBELL_STATUS = bar0 + 0x6620
-DOORBELL_05 = bar0 + 0x174
-DOORBELL_6 = bar0 + 0x154
-REG_21 = bar0 + 0x610
-BTI_MSI_LO = bar0 + 0x580
-BTI_MSI_HI = bar0 + 0x584
-REG_24 = bar0 + 0x588
-HOST_WINDOW_LO = bar0 + 0x590
-HOST_WINDOW_HI = bar0 + 0x594
-HOST_WINDOW_SZ = bar0 + 0x598
-RTI_IMG_LO = bar0 + 0x5a0
-RTI_IMG_HI = bar0 + 0x5a4
-RTI_IMG_SZ = bar0 + 0x5a8
-AXI2AHB_ERROR_STATUS = bar0 + 0x1908
-RTI_MSI_LO = bar1 + 0x2004f8
-RTI_MSI_HI = bar1 + 0x2004fc
-RTI_MSI_DATA = bar1 + 0x200500
-APBBRIDGECB0_ERROR_STATUS = bar0 + 0x5908
-APBBRIDGECB0_ERROR_LO = bar0 + 0x590c
-APBBRIDGECB0_ERROR_HI = bar0 + 0x5910
-APBBRIDGECB0_ERROR_MASTER_ID = bar0 + 0x5914
-
-def divroundup(x, divisor):
-	return (x + divisor - 1) // divisor
-
-def roundto(x, round_to):
-	return round_to * divroundup(x, round_to)
-
-eventfd = libc.eventfd
-eventfd.argtypes = [c_uint, c_int]
-eventfd.restype = c_int
-irqfd = eventfd(0, 0)
-print(f"irq eventfd {irqfd}")
-
-py_irq_evt = threading.Event()
-irq_do_main_stuff=False
-irq_do_magic=False
-msg_irqs = {}
-
-completion_ring_infos = {}
-transfer_ring_infos = {}
-
-def dump_dbs():
-	for i in range(7):
-		print(f"DB{i} val {mmioread32(DOORBELL_STATUS+i*4)}")
-
-def dump_trs():
-	for i in range(NUM_TRANSFER_RINGS):
-		print(f"TR{i} head {get_tr_head(i)} tail {get_tr_tail(i)}")
-
-def dump_crs():
-	for i in range(NUM_COMPLETION_RINGS):
-		print(f"CR{i} head {get_cr_head(i)} tail {get_cr_tail(i)}")
-
-def interrupt_handler():
-	while True:
-		events = struct.unpack("<Q", os.read(irqfd, 8))[0]
-		# print(f"Got {events} interrupts!")
-		py_irq_evt.set()
-
-		if irq_do_main_stuff:
-			# print("dump per info")
-			# chexdump(mapped_memory[per_info_off:per_info_off+PER_INFO_SZ])
-
-			# dump_trs()
-			# dump_crs()
-
-			for cr_idx in range(NUM_COMPLETION_RINGS):
-				if cr_idx not in completion_ring_infos:
-					continue
-				cr_head = get_cr_head(cr_idx)
-				cr_tail = get_cr_tail(cr_idx)
-				cr_off, cr_ring_sz, cr_ent_sz = completion_ring_infos[cr_idx]
-
-				if cr_head >= cr_tail:
-					range_ = range(cr_tail, cr_head)
-				else:
-					range_ = itertools.chain(range(cr_tail, cr_ring_sz), range(0, cr_head))
-
-				for cr_ent_idx in range_:
-					data = mapped_memory[cr_off+cr_ent_idx*cr_ent_sz:cr_off+(cr_ent_idx+1)*cr_ent_sz]
-					# print(f"Data on CR{cr_idx}")
-					# chexdump(data)
-					hdr = CompletionHeader._make(struct.unpack(COMPLETIONHEADER_STR, data[:COMPLETIONHEADER_SZ]))
-					# print(hdr)
-					payload = b''
-					if hdr.flags & 2:
-						payload = data[COMPLETIONHEADER_SZ:COMPLETIONHEADER_SZ+hdr.len_]
-						# chexdump(payload)
-
-					# XXX HACK
-					if hdr.pipe_idx == 6:
-						# print(hdr)
-						if hdr.flags & 1:
-							payload = mapped_memory[pipe6_iobuf_off:pipe6_iobuf_off+hdr.len_]
-						# chexdump(payload)
-
-					if (hdr.pipe_idx, hdr.msg_id) in msg_irqs:
-						msg_irqs[(hdr.pipe_idx, hdr.msg_id)].set()
-
-					set_cr_tail(cr_idx, (cr_ent_idx + 1) % cr_ring_sz)
-
-					barrier()
-					if irq_do_magic:
-						if hdr.pipe_idx == 2:
-							# HCI in
-							# print("HCI in")
-							boop_cr(hdr.pipe_idx)
-							if DO_VHCI:
-								os.write(vhci_fd, b'\x04' + payload)
-						elif hdr.pipe_idx == 6:
-							# ACL in
-							# print("ACL in")
-							send_transfer(hdr.pipe_idx, b'', False)
-							if DO_VHCI:
-								os.write(vhci_fd, b'\x02' + payload)
-						elif hdr.pipe_idx == 4:
-							# SCO in
-							# print("SCO in")
-							# FIXME: are we poking this too many times?
-							boop_cr(hdr.pipe_idx)
-							if DO_VHCI:
-								os.write(vhci_fd, b'\x03' + payload)
-
-irqthread = threading.Thread(target=interrupt_handler)
-irqthread.start()
-
-ioctl(device, VFIO_DEVICE_SET_IRQS, struct.pack("<IIIIII", 24, 0b100100, 1, 0, 1, irqfd))
-
-
-with open('BCM4387C2_19.3.395.4044_PCIE_macOS_MaldivesES2_CLPC_3ANT_OS_USI_20211013.bin', 'rb') as f:
-	firmware = f.read()
-
-fw_sz = len(firmware)
-mapped_memory[:len(firmware)] = firmware
-fw_sz_up = roundto(fw_sz, 0x200)
-print(f"fw size {fw_sz:x}")
-
-# FIXME what is this
-time.sleep(1)
-
-print(mmioread32(BOOTSTAGE))
-
-mmiowrite32(DOORBELL_6, 1)
-mmiowrite32(BTI_MSI_LO, 0xfffff000)
-mmiowrite32(BTI_MSI_HI, 0)
-mmiowrite32(REG_24, 0x200)
-mmiowrite32(REG_21, 0x100)
-mmiowrite32(DOORBELL_6, 1)
-mmiowrite32(BTI_MSI_LO, 0xfffff000)
-mmiowrite32(BTI_MSI_HI, 0)
-mmiowrite32(REG_24, 0x200)
-mmiowrite32(REG_21, 0x100)
-mmiowrite32(HOST_WINDOW_LO, IOVA_START)
-mmiowrite32(HOST_WINDOW_HI, 0)
-mmiowrite32(BAR1_IMG_ADDR_LO, IOVA_START)
-mmiowrite32(BAR1_IMG_ADDR_HI, 0)
-mmiowrite32(HOST_WINDOW_SZ, fw_sz_up)
-mmiowrite32(REG_21, 0x200)
-mmiowrite32(BAR1_IMG_SZ, fw_sz)
-
-print(mmioread32(BOOTSTAGE))
-mmiowrite32(IMG_DOORBELL, 0)
-print(mmioread32(BOOTSTAGE))
-
-
-py_irq_evt.wait()
-py_irq_evt.clear()
-print(mmioread32(BOOTSTAGE))
-print(mmioread32(RTI_GET_CAPABILITY))
-
-for i in range(len(mapped_memory)):
-	mapped_memory[i] = 0
-
-mmiowrite32(REG_21, 0x100)
-mmiowrite32(RTI_MSI_LO, 0xfffff000)
-mmiowrite32(RTI_MSI_HI, 0)
-mmiowrite32(RTI_MSI_DATA, 0)
-mmiowrite32(HOST_WINDOW_LO, IOVA_START)
-mmiowrite32(HOST_WINDOW_HI, 0)
-mmiowrite32(HOST_WINDOW_SZ, SHARED_MEM_SZ)
-mmiowrite32(REG_21, 0x200)
-mmiowrite32(RTI_CONTROL, 1)
-
-py_irq_evt.wait()
-py_irq_evt.clear()
-print("Control is now 1")
-
-
-
-TransferHeader = namedtuple('TransferHeader', [
-	'flags',
-	# bit0 = has payload in buf_iova?
-	# bit1 = has payload in footer
-	'len_',
-	# XXX can length be 3 bytes?
-	'unk_0x3_',
-	'buf_iova',
-	'msg_id',
-	# XXX macos driver takes special effort to munge byte 0xf
-	'unk_0xe_',
-])
-TRANSFERHEADER_STR = "<BH1sQH2s"
-TRANSFERHEADER_SZ = 0x10
-
-CompletionHeader = namedtuple('CompletionHeader', [
-	'flags',
-	# bit1 = has payload in footer
-	'unk_0x1',
-	# normally unk is 4
-	'pipe_idx',
-	'msg_id',
-	'len_',
-	'pad_0xa_',
-])
-COMPLETIONHEADER_STR = "<B1sHHI6s"
-COMPLETIONHEADER_SZ = 0x10
-
-
-ContextStruct = namedtuple('ContextStruct', [
-    'version',
-    'sz',
-    'enabled_caps',
-    'perInfo',
-    'crHIA',
-    'trTIA',
-    'crTIA',
-    'trHIA',
-    'crIAEntry',
-    'trIAEntry',
-    'mcr',
-    'mtr',
-    'mtrEntry',
-    'mcrEntry',
-    'mtrDb',
-    'mcrDb',
-    'mtrMsi',
-    'mcrMsi',
-    'mtrOptHeadSize',
-    'mtrOptFootSize',
-    'mcrOptHeadSize',
-    'mcrOptFootSize',
-    'res_inPlaceComp_oOOComp',
-    'piMsi',
-    'scratchPa',
-    'scratchSize',
-    'res',
-])
-CONTEXTSTRUCT_STR = "<HHIQQQQQHHQQHHHHHHBBBBHHQII"
-CONTEXTSTRUCT_SZ = 0x68
-
-PER_INFO_SZ = 0x10
-
-
-NUM_TRANSFER_RINGS = 9
-NUM_COMPLETION_RINGS = 6
-
-context_off = 0
-per_info_off = roundto(context_off + CONTEXTSTRUCT_SZ, 16)
-transfer_rings_heads_off = roundto(per_info_off + PER_INFO_SZ, 16)
-transfer_rings_tails_off = transfer_rings_heads_off + NUM_TRANSFER_RINGS*2
-completion_rings_heads_off = transfer_rings_tails_off + NUM_TRANSFER_RINGS*2
-completion_rings_tails_off = completion_rings_heads_off + NUM_COMPLETION_RINGS*2
-transfer_ring_0_off = roundto(completion_rings_tails_off + NUM_COMPLETION_RINGS*2, 16)
-completion_ring_0_off = roundto(transfer_ring_0_off + TRANSFERHEADER_SZ * 128, 16)
-ring0_iobuf_off = roundto(completion_ring_0_off + COMPLETIONHEADER_SZ * 128, 16)
-
-def pipe2db(pipe):
-	if pipe == 0:	# control
-		return 0
-	elif pipe == 1:	# HCI
-		return 1
-	elif pipe == 2:	# HCI
-		return 2
-	elif pipe == 3:	# SCO
-		return 6	# XXX special
-	elif pipe == 4:	# SCO
-		return 6	# XXX special
-	elif pipe == 5:	# ACL
-		return 3
-	elif pipe == 6: # ACL
-		return 4
-	elif pipe == 8:	# debug
-		return 5
-	else:
-		assert False
-
-def get_tr_head(idx):
-	return struct.unpack("<H", mapped_memory[transfer_rings_heads_off+idx*2:transfer_rings_heads_off+idx*2+2])[0]
-def get_tr_tail(idx):
-	return struct.unpack("<H", mapped_memory[transfer_rings_tails_off+idx*2:transfer_rings_tails_off+idx*2+2])[0]
-def get_cr_head(idx):
-	return struct.unpack("<H", mapped_memory[completion_rings_heads_off+idx*2:completion_rings_heads_off+idx*2+2])[0]
-def get_cr_tail(idx):
-	return struct.unpack("<H", mapped_memory[completion_rings_tails_off+idx*2:completion_rings_tails_off+idx*2+2])[0]
-
-def set_tr_head(idx, val):
-	# print(f"TR{idx} head -> {val}")
-	mapped_memory[transfer_rings_heads_off+idx*2:transfer_rings_heads_off+idx*2+2] = struct.pack("<H", val)
-def set_tr_tail(idx, val):
-	# print(f"TR{idx} tail -> {val}")
-	mapped_memory[transfer_rings_tails_off+idx*2:transfer_rings_tails_off+idx*2+2] = struct.pack("<H", val)
-def set_cr_head(idx, val):
-	# print(f"CR{idx} head -> {val}")
-	mapped_memory[completion_rings_heads_off+idx*2:completion_rings_heads_off+idx*2+2] = struct.pack("<H", val)
-def set_cr_tail(idx, val):
-	# print(f"CR{idx} tail -> {val}")
-	mapped_memory[completion_rings_tails_off+idx*2:completion_rings_tails_off+idx*2+2] = struct.pack("<H", val)
-
-ctx = ContextStruct(
-	version=1,
-	sz=CONTEXTSTRUCT_SZ,
-	enabled_caps=0xa,
-	perInfo=IOVA_START + per_info_off,
-	crHIA=IOVA_START + completion_rings_heads_off,
-	crTIA=IOVA_START + completion_rings_tails_off,
-	trHIA=IOVA_START + transfer_rings_heads_off,
-	trTIA=IOVA_START + transfer_rings_tails_off,
-	crIAEntry=NUM_COMPLETION_RINGS,
-	trIAEntry=NUM_TRANSFER_RINGS,
-	mcr=IOVA_START + completion_ring_0_off,
-	mtr=IOVA_START + transfer_ring_0_off,
-	mtrEntry=128,
-	mcrEntry=128,
-	mtrDb=0,
-	mcrDb=0xffff,
-	mtrMsi=0,
-	mcrMsi=0,
-	mtrOptHeadSize=0,
-	mtrOptFootSize=0,
-	mcrOptHeadSize=0,
-	mcrOptFootSize=0,
-	res_inPlaceComp_oOOComp=0,
-	piMsi=0,
-	scratchPa=0,
-	scratchSize=0,
-	res=0
-)
-ctx_ = struct.pack(CONTEXTSTRUCT_STR, *ctx)
-chexdump(ctx_)
-
-mapped_memory[context_off:context_off+CONTEXTSTRUCT_SZ] = ctx_
-barrier()
-
-irq_do_main_stuff=True
-mmiowrite32(RTI_WINDOW_LO, IOVA_START+context_off)
-mmiowrite32(RTI_WINDOW_HI, 0)
-mmiowrite32(RTI_WINDOW_SZ, SHARED_MEM_SZ)
-mmiowrite32(RTI_CONTEXT_LO, IOVA_START+context_off)
-mmiowrite32(RTI_CONTEXT_HI, 0)
-mmiowrite32(RTI_CONTROL, 2)
-
-py_irq_evt.wait()
-py_irq_evt.clear()
-print("Control is now 2")
-
-
-OpenCompletionRingMessage = namedtuple('OpenCompletionRingMessage', [
-    'msg_type',
-    'head_size',
-    'foot_size',
-    'pad_0x3_',
-    'cr_idx',
-    'cr_idx_',
-    'ring_iova',
-    'ring_count',
-    'unk_0x12_',
-    'pad_0x16_',
-    'msi',
-    'intmod_delay',
-    'intmod_bytes',
-    'accum_delay',
-    'accum_bytes',
-    'pad_0x2a_',
-])
-OPENCOMPLETIONRING_STR = "<BBB1sHHQHI6sHHIHI10s"
-
-OpenPipeMessage = namedtuple('OpenPipeMessage', [
-    'msg_type',
-    'head_size',
-    'foot_size',
-    'pad_0x3_',
-    'pipe_idx',
-    'pipe_idx_',
-    'ring_iova',
-    'pad_0x10_',
-    'ring_count',
-    'completion_ring_index',
-    'doorbell_idx',
-    'flags',
-    # bit3 = oc
-    # bit4 = reliable
-    # bit7 = virtual (no ring_iova)
-    # bit8 = sync
-    'pad_0x20_',
-])
-OPENPIPE_STR = "<BBB1sHHQ8sHHHH20s"
-
-
-transfer_ring_infos[0] = (transfer_ring_0_off, 128, TRANSFERHEADER_SZ)
-
-
-msg_ids = {}
-def send_transfer(pipe, data, wait=True):
-	global msg_ids
-
-	if pipe not in msg_ids:
-		msg_id = 0
-	else:
-		msg_id = msg_ids[pipe]
-
-	tr_base, tr_ring_sz, tr_ent_sz = transfer_ring_infos[pipe]
-
-	tr_head = get_tr_head(pipe)
-	tr_off = tr_base + tr_head*tr_ent_sz
-	len_ = len(data)
-	if pipe == 0:
-		assert len(data) == 0x34
-		mapped_memory[ring0_iobuf_off:ring0_iobuf_off+len(data)] = data
-		xfer_iova = IOVA_START+ring0_iobuf_off
-		flags = 1
-	elif pipe == 6:
-		# XXX this is a hack
-		assert len(data) == 0
-		len_ = 0x1000
-		assert wait == False
-		xfer_iova = IOVA_START+pipe6_iobuf_off
-		flags = 1
-	elif pipe == 5:
-		# XXX this is also a hack
-		if len(data) <= tr_ent_sz - TRANSFERHEADER_SZ:
-			mapped_memory[tr_off+TRANSFERHEADER_SZ:tr_off+TRANSFERHEADER_SZ+len(data)] = data
-			xfer_iova = 0
-			flags = 2
-		else:
-			mapped_memory[pipe5_iobuf_off:pipe5_iobuf_off+len(data)] = data
-			xfer_iova = IOVA_START+pipe5_iobuf_off
-			flags=1
-	else:
-		assert len(data) <= tr_ent_sz - TRANSFERHEADER_SZ
-		mapped_memory[tr_off+TRANSFERHEADER_SZ:tr_off+TRANSFERHEADER_SZ+len(data)] = data
-		xfer_iova = 0
-		flags = 2
-
-	transfer_hdr = TransferHeader(
-		flags=flags,
-		len_=len_,
-		unk_0x3_=b'\x00',
-		buf_iova=xfer_iova,
-		msg_id=msg_id,
-		unk_0xe_=b'\x00\x00'
-	)
-	transfer_hdr_ = struct.pack(TRANSFERHEADER_STR, *transfer_hdr)
-	# chexdump(transfer_hdr_)
-	mapped_memory[tr_off:tr_off+TRANSFERHEADER_SZ] = transfer_hdr_
-	new_tr_head = (tr_head + 1) % tr_ring_sz
-	set_tr_head(pipe, new_tr_head)
-	barrier()
-
-	if wait:
-		evt = threading.Event()
-		msg_irqs[(pipe, msg_id)] = evt
-
-	doorbell = pipe2db(pipe)
-	if doorbell != 6:
-		mmiowrite32(DOORBELL_05, new_tr_head << 16 | doorbell << 8 | 0x20)
-	else:
-		mmiowrite32(DOORBELL_6, 1)
-
-	if wait:
-		evt.wait()
-		del evt
-		del msg_irqs[(pipe, msg_id)]
-
-	msg_id = (msg_id + 1) % tr_ring_sz
-	msg_ids[pipe] = msg_id
-
-
-completion_ring_infos[0] = (completion_ring_0_off, 128, COMPLETIONHEADER_SZ)
-
-for i in range(1, 6):
-	print(f"opening CR{i}")
-	if i == 1:
-		ring_off = roundto(ring0_iobuf_off + 0x34, 16)
-	else:
-		prev_ring_info = completion_ring_infos[i-1]
-		ring_off = roundto(prev_ring_info[0] + prev_ring_info[1] * prev_ring_info[2], 16)
-
-	if i == 1 or i == 2:
-		ring_ents = 256
-	else:
-		ring_ents = 128
-
-	if i == 1 or i == 3:
-		foot_sz = 0
-	else:
-		foot_sz = 66
-	ring_ent_sz = COMPLETIONHEADER_SZ + foot_sz*4
-
-	if i == 1 or i == 2:
-		intmod_delay = 1000
+	if args.emulate:
+		ctrls = [{'name': f'emu{i}', 'firmware': None, 'ptb': None, 'calibration': None} for i in range(args.emulate)]
+	elif args.config:
+		ctrls = load_config(args.config)
 	else:
-		intmod_delay = 0
-
-	completion_ring_infos[i] = (ring_off, ring_ents, ring_ent_sz)
-
-	opencr = OpenCompletionRingMessage(
-		msg_type=2,
-		head_size=0,
-		foot_size=foot_sz,
-		pad_0x3_=b'\x00',
-		cr_idx=i,
-		cr_idx_=i,
-		ring_iova=IOVA_START+ring_off,
-		ring_count=ring_ents,
-		unk_0x12_=0xffffffff,
-		pad_0x16_=b'\x00\x00\x00\x00\x00\x00',
-		msi=0,
-		intmod_delay=intmod_delay,
-		intmod_bytes=0xffffffff,
-		accum_delay=0,
-		accum_bytes=0,
-		pad_0x2a_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00',
-	)
-	print(opencr)
-	opencr_ = struct.pack(OPENCOMPLETIONRING_STR, *opencr)
-	# chexdump(opencr_)
-	send_transfer(0, opencr_)
-
-# HCI pipes
-prev_ring_info = completion_ring_infos[5]
-pipe1_ring_off = roundto(prev_ring_info[0] + prev_ring_info[1] * prev_ring_info[2], 16)
-openpipe = OpenPipeMessage(
-	msg_type=1,
-	head_size=0,
-	foot_size=66,
-	pad_0x3_=b'\x00',
-	pipe_idx=1,
-	pipe_idx_=1,
-	ring_iova=IOVA_START+pipe1_ring_off,
-	pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
-	ring_count=128,
-	completion_ring_index=1,
-	doorbell_idx=1,
-	flags=0,
-	pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-print(openpipe)
-openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
-# chexdump(openpipe_)
-send_transfer(0, openpipe_)
-transfer_ring_infos[1] = (pipe1_ring_off, 128, TRANSFERHEADER_SZ + 66*4)
-
-openpipe = OpenPipeMessage(
-	msg_type=1,
-	head_size=0,
-	foot_size=0,
-	pad_0x3_=b'\x00',
-	pipe_idx=2,
-	pipe_idx_=2,
-	ring_iova=0,
-	pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
-	ring_count=128,
-	completion_ring_index=2,
-	doorbell_idx=2,
-	flags=0x80,
-	pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-print(openpipe)
-openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
-# chexdump(openpipe_)
-send_transfer(0, openpipe_)
-transfer_ring_infos[2] = (0xdeadbeefdeadbeef, 128, TRANSFERHEADER_SZ)
-
-# XXX this function might be busticated
-def boop_cr(pipe):
-	tr_head = get_tr_head(pipe)
-	new_tr_head = (tr_head + 1) % transfer_ring_infos[pipe][1]
-	set_tr_head(pipe, new_tr_head)
-
-	doorbell = pipe2db(pipe)
-	if doorbell != 6:
-		mmiowrite32(DOORBELL_05, new_tr_head << 16 | doorbell << 8 | 0x20)
-	else:
-		mmiowrite32(DOORBELL_6, 1)
-
-
-# XXX this function is super busticated
-def recv_from_pipe(pipe):
-	if pipe == 1:
-		cr_idx = 1
-	elif pipe == 2:
-		cr_idx = 2
-	else:
-		assert False
-
-	cr_head = get_cr_head(cr_idx)
-
-	evt = threading.Event()
-	msg_irqs[(pipe, cr_head)] = evt
-
-	boop_cr(pipe)
-
-	evt.wait()
-	del evt
-	del msg_irqs[(pipe, cr_head)]
-
-# BLOB
-with open('bluetooth-taurus-calibration-bf.bin', 'rb') as f:
-	cal_blob = f.read()
-
-remaining_count = divroundup(len(cal_blob), 0xe6) - 1
-for chunk_off in range(0, len(cal_blob), 0xe6):
-	blob_chunk = cal_blob[chunk_off:chunk_off+0xe6]
-	if len(blob_chunk) != 0xe6:
-		blob_chunk += b'\x00' * (0xe6 - len(blob_chunk))
-	command = struct.pack("<HBBH", 0xfd97, 0xe9, 0x03, remaining_count) + blob_chunk
-	send_transfer(1, command)
-	recv_from_pipe(2)
-	remaining_count -=1
-assert remaining_count == -1
-
-# PTB
-with open('BCM4387C2_DVT_Finalv1_PCIE_macOS_MaldivesES2_CLPC_3ANT_OS_USI_K_R_20210723.ptb', 'rb') as f:
-	ptb_blob = f.read()
-
-remaining_count = divroundup(len(ptb_blob), 0xcf) - 1
-for chunk_off in range(0, len(ptb_blob), 0xcf):
-	blob_chunk = ptb_blob[chunk_off:chunk_off+0xcf]
-	if len(blob_chunk) != 0xcf:
-		blob_chunk += b'\x00' * (0xcf - len(blob_chunk))
-	command = struct.pack("<HBH", 0xfe0d, 0xd1, remaining_count) + blob_chunk
-	send_transfer(1, command)
-	recv_from_pipe(2)
-	remaining_count -=1
-assert remaining_count == -1
-
-# reset
-send_transfer(1, b'\x03\x0c\x00')
-recv_from_pipe(2)
-
-
-
-# SCO pipes
-prev_ring_info = transfer_ring_infos[1]
-pipe3_ring_off = roundto(prev_ring_info[0] + prev_ring_info[1] * prev_ring_info[2], 16)
-openpipe = OpenPipeMessage(
-	msg_type=1,
-	head_size=0,
-	foot_size=66,
-	pad_0x3_=b'\x00',
-	pipe_idx=3,
-	pipe_idx_=3,
-	ring_iova=IOVA_START+pipe3_ring_off,
-	pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
-	ring_count=128,
-	completion_ring_index=3,
-	doorbell_idx=6,
-	flags=0x100,
-	pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-print(openpipe)
-openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
-# chexdump(openpipe_)
-send_transfer(0, openpipe_)
-transfer_ring_infos[3] = (pipe3_ring_off, 128, TRANSFERHEADER_SZ + 66*4)
-
-openpipe = OpenPipeMessage(
-	msg_type=1,
-	head_size=0,
-	foot_size=0,
-	pad_0x3_=b'\x00',
-	pipe_idx=4,
-	pipe_idx_=4,
-	ring_iova=0,
-	pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
-	ring_count=128,
-	completion_ring_index=4,
-	doorbell_idx=6,
-	flags=0x180,
-	pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-print(openpipe)
-openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
-# chexdump(openpipe_)
-send_transfer(0, openpipe_)
-transfer_ring_infos[4] = (0xdeadbeefdeadbeef, 128, TRANSFERHEADER_SZ)
-
-# ACL pipes
-prev_ring_info = transfer_ring_infos[3]
-pipe5_ring_off = roundto(prev_ring_info[0] + prev_ring_info[1] * prev_ring_info[2], 16)
-openpipe = OpenPipeMessage(
-	msg_type=1,
-	head_size=0,
-	foot_size=252,
-	pad_0x3_=b'\x00',
-	pipe_idx=5,
-	pipe_idx_=5,
-	ring_iova=IOVA_START+pipe5_ring_off,
-	pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
-	ring_count=128,
-	completion_ring_index=1,
-	doorbell_idx=3,
-	flags=0,
-	pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-print(openpipe)
-openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
-# chexdump(openpipe_)
-send_transfer(0, openpipe_)
-transfer_ring_infos[5] = (pipe5_ring_off, 128, TRANSFERHEADER_SZ + 252*4)
-
-prev_ring_info = transfer_ring_infos[5]
-pipe6_ring_off = roundto(prev_ring_info[0] + prev_ring_info[1] * prev_ring_info[2], 16)
-openpipe = OpenPipeMessage(
-	msg_type=1,
-	head_size=0,
-	foot_size=0,
-	pad_0x3_=b'\x00',
-	pipe_idx=6,
-	pipe_idx_=6,
-	ring_iova=IOVA_START+pipe6_ring_off,
-	pad_0x10_=b'\x00\x00\x00\x00\x00\x00\x00\x00',
-	ring_count=128,
-	completion_ring_index=2,
-	doorbell_idx=4,
-	flags=0,
-	pad_0x20_=b'\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00\x00')
-print(openpipe)
-openpipe_ = struct.pack(OPENPIPE_STR, *openpipe)
-# chexdump(openpipe_)
-send_transfer(0, openpipe_)
-transfer_ring_infos[6] = (pipe6_ring_off, 128, TRANSFERHEADER_SZ)
-
-prev_ring_info = transfer_ring_infos[6]
-pipe6_iobuf_off = roundto(prev_ring_info[0] + prev_ring_info[1] * prev_ring_info[2], 16)
-pipe5_iobuf_off = pipe6_iobuf_off + 0x1000
-
-
-
-if DO_VHCI:
-	vhci_fd = os.open('/dev/vhci', os.O_RDWR)
-	# os.write(vhci_fd, b'\xff\x00')
-
-boop_cr(2)
-boop_cr(4)
-send_transfer(6, b'', False)
-irq_do_magic = True
-
-if DO_VHCI:
-	while True:
-		vhci_packet = os.read(vhci_fd, 1024)
-		# chexdump(vhci_packet)
-		if vhci_packet[0] == 0x01:
-			# print("HCI out")
-			send_transfer(1, vhci_packet[1:], False)
-		elif vhci_packet[0] == 0x02:
-			# print("\x1b[31mACL out\x1b[0m")
-			# chexdump(vhci_packet)
-			send_transfer(5, vhci_packet[1:], False)
-		elif vhci_packet[0] == 0x03:
-			# print("\x1b[31mSCO out\x1b[0m")
-			# chexdump(vhci_packet)
-			send_transfer(3, vhci_packet[1:], False)
-		elif vhci_packet[0] == 0xff:
-			print("vendor command")
+		ctrls = [{'bdf': bdf, 'group': group} for bdf, group in find_controllers()]
+
+	if not args.emulate and any('group' not in ctrl for ctrl in ctrls):
+		groups = dict(find_controllers())
+		for ctrl in ctrls:
+			ctrl.setdefault('group', groups[ctrl['bdf']])
+
+	cfgs = []
+	for i, ctrl in enumerate(ctrls):
+		ctrl.setdefault('name', ctrl.get('bdf'))
+		# every controller gets its own slice of iova space
+		ctrl.setdefault('iova_start', IOVA_START + i*ctrl.get('shared_mem_sz', SHARED_MEM_SZ))
+		if args.no_vhci:
+			ctrl['vhci'] = None
+		if args.hugepages:
+			ctrl.setdefault('dma_backing', args.hugepages)
+		if args.prefault:
+			ctrl.setdefault('dma_prefault', True)
+		if args.mlock:
+			ctrl.setdefault('dma_mlock', True)
+		if args.trace:
+			ctrl.setdefault('trace', f"trace-{ctrl['name']}.bin")
+		if args.submit_workers:
+			ctrl.setdefault('submit_workers', True)
+		if args.pin_cpus:
+			ctrl.setdefault('submit_cpus', [int(cpu) for cpu in args.pin_cpus.split(',')])
+		if args.watchdog is not None:
+			ctrl.setdefault('stall_timeout', args.watchdog / 1000)
+		if args.idle_timeout is not None:
+			ctrl.setdefault('idle_timeout', args.idle_timeout / 1000)
+		if args.dump_packets:
+			ctrl.setdefault('packet_dump', args.dump_packets)
+		if args.debug_log:
+			ctrl.setdefault('debug_log', f"fwlog-{ctrl['name']}.txt")
+		cfgs.append(ControllerConfig(**ctrl))
+	return cfgs
+
+
+def run(drv):
+	drv.bring_up()
+	if drv.vhci_fd is not None:
+		drv.run_vhci()
+
+
+def main():
+	parser = argparse.ArgumentParser(description="Userspace driver for the BCM4387 PCIe Bluetooth function")
+	parser.add_argument('--config', help="JSON file describing the controllers to drive (default: scan sysfs)")
+	parser.add_argument('--emulate', type=int, default=0, metavar='N', help="drive N emulated controllers instead of hardware")
+	parser.add_argument('--no-vhci', action='store_true', help="don't forward traffic to /dev/vhci")
+	parser.add_argument('--hugepages', nargs='?', const='hugetlb', metavar='HUGETLBFS', help="back DMA memory with hugepages (MAP_HUGETLB, or files in a hugetlbfs mount)")
+	parser.add_argument('--prefault', action='store_true', help="fault in DMA memory when it is mapped")
+	parser.add_argument('--mlock', action='store_true', help="mlock DMA memory")
+	parser.add_argument('--debug-log', action='store_true', help="open the firmware debug pipe and log it to fwlog-<name>.txt")
+	parser.add_argument('--submit-workers', action='store_true', help="give each pipe a thread that owns its ring, fed through lock-free queues")
+	parser.add_argument('--pin-cpus', help="CPUs to pin those threads to, e.g. 2,3")
+	parser.add_argument('--watchdog', type=float, metavar='MS', help="reset and re-init a controller whose TX rings stop moving for MS milliseconds")
+	parser.add_argument('--idle-timeout', type=float, metavar='MS', help="quiesce the device after MS milliseconds without ring activity")
+	parser.add_argument('--dump-packets', type=int, metavar='N', help="hexdump 1 in every N VHCI packets (first 64 bytes)")
+	parser.add_argument('--trace', action='store_true', help="record hot path events, written to trace-<name>.bin on SIGUSR1 or exit")
+	args = parser.parse_args()
+
+	cfgs = make_configs(args)
+	if not cfgs:
+		print("no controllers found")
+		return
+
+	drivers = []
+	for cfg in cfgs:
+		if args.emulate:
+			from emu import EmuDevice
+			hw = EmuDevice(cfg.name)
 		else:
-			print("UNKNOWN VHCI command")
-
+			from vfio import VfioDevice
+			hw = VfioDevice(cfg.group, cfg.bdf)
+		drivers.append(BTDriver(hw, cfg))
+
+	def dump_traces(signum, frame):
+		for drv in drivers:
+			drv.dump_trace()
+	signal.signal(signal.SIGUSR1, dump_traces)
+
+	def dump_dma(signum, frame):
+		for drv in drivers:
+			if drv.arena is not None:
+				drv.dump_dma(f"dma-{drv.cfg.name}.txt")
+	signal.signal(signal.SIGUSR2, dump_dma)
+
+	# daemon, the VHCI reads don't return until close() and exit pull them down
+	threads = [threading.Thread(target=run, args=(drv,), name=drv.cfg.name, daemon=True) for drv in drivers]
+	for thread in threads:
+		thread.start()
+	try:
+		for thread in threads:
+			thread.join()
+	finally:
+		# writes the trace and prints the per driver reports
+		for drv in drivers:
+			drv.close()
+
+
+if __name__ == '__main__':
+	main()
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+
+"""Convert driver trace buffers to Chrome trace / Perfetto JSON"""
+
+import argparse
+import json
+
+from bttrace import *
+from util import percentile
+
+
+def convert(paths):
+	events = []
+	latencies = {}
+	for pid, path in enumerate(paths):
+		name, records = read_trace(path)
+		events.append({'name': 'process_name', 'ph': 'M', 'pid': pid, 'args': {'name': name or path}})
+
+		submits = {}
+		for ts, event, pipe, msg_id, arg in records:
+			ts_us = ts / 1000
+			if event == TR_IRQ:
+				tid = 'irq'
+			elif event == TR_CR_HEAD:
+				tid = f'CR{pipe}'
+			else:
+				tid = f'pipe {pipe}'
+			events.append({
+				'name': EVENT_NAMES.get(event, str(event)),
+				'ph': 'i',
+				's': 't',
+				'ts': ts_us,
+				'pid': pid,
+				'tid': tid,
+				'args': {'msg_id': msg_id, 'arg': arg},
+			})
+
+			# pair each submit with its completion to get a span
+			if event == TR_SUBMIT:
+				submits[(pipe, msg_id)] = ts
+			elif event == TR_COMPLETION and (pipe, msg_id) in submits:
+				start = submits.pop((pipe, msg_id))
+				events.append({
+					'name': f'pipe {pipe} transfer',
+					'ph': 'X',
+					'ts': start / 1000,
+					'dur': (ts - start) / 1000,
+					'pid': pid,
+					'tid': f'pipe {pipe}',
+					'args': {'msg_id': msg_id},
+				})
+				latencies.setdefault(pipe, []).append(ts - start)
+	return events, latencies
+
+
+def main():
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('traces', nargs='+', help="trace files written by the driver")
+	parser.add_argument('-o', '--output', default='trace.json', help="JSON file to write (default: trace.json)")
+	args = parser.parse_args()
+
+	events, latencies = convert(args.traces)
+	with open(args.output, 'w') as f:
+		json.dump({'traceEvents': events, 'displayTimeUnit': 'ns'}, f)
+	print(f"wrote {len(events)} events to {args.output}")
+
+	for pipe, values in sorted(latencies.items()):
+		print(f"pipe {pipe}: {len(values)} transfers, submit->completion p50 {percentile(values, 50)/1000:.1f} us p99 {percentile(values, 99)/1000:.1f} us")
+
+
+if __name__ == '__main__':
+	main()
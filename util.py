@@ -0,0 +1,97 @@
+# printable ASCII maps to itself, everything else to '.'
+_ASCII_TABLE = bytes(c if 0x20 <= c <= 0x7e else ord('.') for c in range(256))
+
+def _ascii(s):
+    return bytes(s).translate(_ASCII_TABLE).decode('ascii')
+
+def hexdump(s, sep=" "):
+    if len(sep) == 1:
+        return bytes(s).hex(sep)
+    elif not sep:
+        return bytes(s).hex()
+    return sep.join(["%02x"%x for x in s])
+
+def _row(val, addr, indent):
+    return "%s%08x  %s  %s  |%s|" % (
+          indent,
+          addr,
+          val[:8].hex(' ').ljust(23),
+          val[8:].hex(' ').ljust(23),
+          val.translate(_ASCII_TABLE).decode('ascii').ljust(16))
+
+def chexdump_lines(s, st=0, abbreviate=True, indent="", block=0x10000):
+    """Same output as chexdump, one line at a time"""
+    s = memoryview(s).cast('B')
+    last = None
+    skip = False
+    # hex and ascii are done a block at a time, rows are just slices of those
+    for base in range(0, len(s), block):
+        data = s[base:base+block].tobytes()
+        hexed = data.hex(' ')
+        text = data.translate(_ASCII_TABLE).decode('ascii')
+        for i in range(0, len(data), 16):
+            val = data[i:i+16]
+            if val == last and abbreviate:
+                if not skip:
+                    yield indent+"%08x  *" % (base + i + st)
+                    skip = True
+                continue
+            last = val
+            skip = False
+            if len(val) == 16:
+                yield "%s%08x  %s  %s  |%s|" % (indent, base + i + st, hexed[i*3:i*3+23], hexed[i*3+24:i*3+47], text[i:i+16])
+            else:
+                yield _row(val, base + i + st, indent)
+
+def chexdump(s, st=0, abbreviate=True, indent="", print_fn=print):
+    for line in chexdump_lines(s, st, abbreviate, indent):
+        print_fn(line)
+
+def chexdump_file(f, s, st=0, abbreviate=True, indent="", chunk_lines=4096):
+    """Stream a hexdump of a large region to a file without building it all in memory"""
+    lines = []
+    for line in chexdump_lines(s, st, abbreviate, indent):
+        lines.append(line)
+        if len(lines) == chunk_lines:
+            lines.append("")
+            f.write("\n".join(lines))
+            lines = []
+    if lines:
+        lines.append("")
+        f.write("\n".join(lines))
+
+class DumpSampler:
+    """
+    Hexdump 1 in every `every` packets, and at most the first `max_bytes` of
+    each, so packet logging can be left on without eating the data path.
+    """
+
+    def __init__(self, every=1, max_bytes=None, print_fn=print):
+        self.every = every
+        self.max_bytes = max_bytes
+        self.print_fn = print_fn
+        self.seen = 0
+
+    def __call__(self, s, what=""):
+        self.seen += 1
+        if self.seen % self.every:
+            return
+        if self.max_bytes is not None and len(s) > self.max_bytes:
+            self.print_fn(f"{what} {len(s)} bytes, first {self.max_bytes}:")
+            s = memoryview(s)[:self.max_bytes]
+        else:
+            self.print_fn(f"{what} {len(s)} bytes:")
+        chexdump(s, print_fn=self.print_fn)
+
+
+def divroundup(x, divisor):
+	return (x + divisor - 1) // divisor
+
+def roundto(x, round_to):
+	return round_to * divroundup(x, round_to)
+
+def percentile(values, p):
+	values = sorted(values)
+	if not values:
+		return 0
+	return values[min(len(values) - 1, int(len(values) * p / 100))]
@@ -0,0 +1,218 @@
+import array
+from ctypes import *
+from fcntl import ioctl
+import mmap
+import os
+import struct
+
+
+VFIO_IOCTL_BASE = 0x3B64
+VFIO_GET_API_VERSION = VFIO_IOCTL_BASE + 0
+VFIO_CHECK_EXTENSION = VFIO_IOCTL_BASE + 1
+VFIO_SET_IOMMU = VFIO_IOCTL_BASE + 2
+VFIO_GROUP_GET_STATUS = VFIO_IOCTL_BASE + 3
+VFIO_GROUP_SET_CONTAINER = VFIO_IOCTL_BASE + 4
+VFIO_GROUP_GET_DEVICE_FD = VFIO_IOCTL_BASE + 6
+VFIO_DEVICE_GET_INFO = VFIO_IOCTL_BASE + 7
+VFIO_DEVICE_GET_REGION_INFO = VFIO_IOCTL_BASE + 8
+VFIO_DEVICE_GET_IRQ_INFO = VFIO_IOCTL_BASE + 9
+VFIO_DEVICE_SET_IRQS = VFIO_IOCTL_BASE + 10
+VFIO_DEVICE_RESET = VFIO_IOCTL_BASE + 11
+VFIO_IOMMU_GET_INFO = VFIO_IOCTL_BASE + 12
+VFIO_IOMMU_MAP_DMA = VFIO_IOCTL_BASE + 13
+
+VFIO_TYPE1_IOMMU = 1
+
+BT_VENDOR_ID = 0x14e4
+BT_DEVICE_ID = 0x5f71
+
+SYSFS_PCI_DEVICES = '/sys/bus/pci/devices'
+
+
+def find_controllers(vendor=BT_VENDOR_ID, device=BT_DEVICE_ID):
+	"""Scan sysfs for matching functions bound to vfio-pci, returns [(bdf, group)]"""
+	found = []
+	for bdf in sorted(os.listdir(SYSFS_PCI_DEVICES)):
+		path = os.path.join(SYSFS_PCI_DEVICES, bdf)
+		try:
+			with open(os.path.join(path, 'vendor')) as f:
+				dev_vendor = int(f.read(), 16)
+			with open(os.path.join(path, 'device')) as f:
+				dev_device = int(f.read(), 16)
+		except OSError:
+			continue
+		if dev_vendor != vendor or dev_device != device:
+			continue
+
+		driver = os.path.join(path, 'driver')
+		if not os.path.islink(driver) or os.path.basename(os.readlink(driver)) != 'vfio-pci':
+			print(f"{bdf} is not bound to vfio-pci, skipping")
+			continue
+
+		group = int(os.path.basename(os.readlink(os.path.join(path, 'iommu_group'))))
+		found.append((bdf, group))
+	return found
+
+
+libc = CDLL('libc.so.6')
+
+libc_mmap = libc.mmap
+libc_mmap.argtypes = [c_void_p, c_size_t, c_int, c_int, c_int, c_longlong]
+libc_mmap.restype = c_void_p
+
+_libglue = None
+def _glue():
+	global _libglue
+	if _libglue is None:
+		_libglue = CDLL(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'glue.so'))
+
+		# eww
+		_libglue.read32.argtypes = [c_void_p]
+		_libglue.read32.restype = c_uint
+
+		_libglue.write32.argtypes = [c_void_p, c_uint]
+		_libglue.write32.restype = None
+
+		_libglue.barrier.argtypes = []
+		_libglue.barrier.restype = None
+	return _libglue
+
+
+class VfioGroup:
+	"""An IOMMU group together with the container it is attached to"""
+
+	# groups can only be attached to one container, so share them between
+	# all controllers in the process
+	_groups = {}
+
+	@classmethod
+	def get(cls, group_num):
+		if group_num not in cls._groups:
+			cls._groups[group_num] = cls(group_num)
+		return cls._groups[group_num]
+
+	def __init__(self, group_num):
+		self.container = os.open('/dev/vfio/vfio', os.O_RDWR)
+		print(f"container fd = {self.container}")
+
+		api_ver = ioctl(self.container, VFIO_GET_API_VERSION, 0)
+		print(f"api_ver = {api_ver}")
+		assert api_ver == 0
+
+		check_ext = ioctl(self.container, VFIO_CHECK_EXTENSION, VFIO_TYPE1_IOMMU)
+		print(f"iommu extension {check_ext}")
+		assert check_ext != 0
+
+		self.fd = os.open(f'/dev/vfio/{group_num}', os.O_RDWR)
+		print(f"group {group_num} fd = {self.fd}")
+
+		group_status = ioctl(self.fd, VFIO_GROUP_GET_STATUS, struct.pack("<II", 8, 0))
+		_, flags = struct.unpack("<II", group_status)
+		print(f"group flags = {flags}")
+		assert flags & 1 != 0
+
+		ioctl(self.fd, VFIO_GROUP_SET_CONTAINER, struct.pack("<I", self.container))
+		ret = ioctl(self.container, VFIO_SET_IOMMU, VFIO_TYPE1_IOMMU)
+		assert ret == 0
+
+		iommu_info = ioctl(self.container, VFIO_IOMMU_GET_INFO, struct.pack("<IIQI", 20, 0, 0, 0))
+		argsz, flags, iova_pgsizes, cap_offset = struct.unpack("<IIQI", iommu_info)
+		print("iommu info", argsz, flags, iova_pgsizes, cap_offset)
+
+	def get_device(self, bdf):
+		return ioctl(self.fd, VFIO_GROUP_GET_DEVICE_FD, array.array('b', bdf.encode()))
+
+
+class VfioDevice:
+	"""Real hardware behind vfio-pci"""
+
+	# FIXME what is this
+	boot_delay = 1
+
+	def __init__(self, group_num, bdf):
+		self.group = VfioGroup.get(group_num)
+		self.device = self.group.get_device(bdf)
+		print(f"{bdf} device fd = {self.device}")
+
+		device_info = ioctl(self.device, VFIO_DEVICE_GET_INFO, struct.pack("<IIIII", 20, 0, 0, 0, 0))
+		argsz, flags, num_regions, num_irqs, cap_offset = struct.unpack("<IIIII", device_info)
+		print("device info", argsz, flags, num_regions, num_irqs, cap_offset)
+
+		for rgn in range(num_regions):
+			try:
+				region_info = ioctl(self.device, VFIO_DEVICE_GET_REGION_INFO, struct.pack("<IIIIQQ", 32, 0, rgn, 0, 0, 0))
+				argsz, flags, index, cap_offset, size, offset = struct.unpack("<IIIIQQ", region_info)
+				print(f"region {index} argsz {argsz} flags {flags} cap_offset {cap_offset} size {size:016X} offset {offset:016X}")
+
+				if index == 0:
+					self.bar0_sz = size
+					self.bar0_off = offset
+
+				if index == 2:
+					self.bar1_sz = size
+					self.bar1_off = offset
+
+				if index == 7:
+					self.cfg_sz = size
+					self.cfg_off = offset
+
+			except OSError as e:
+				print(e)
+
+		for irq in range(num_irqs):
+			irq_info = ioctl(self.device, VFIO_DEVICE_GET_IRQ_INFO, struct.pack("<IIII", 16, 0, irq, 0))
+			argsz, flags, index, count = struct.unpack("<IIII", irq_info)
+			print(f"irq {index} argsz {argsz} flags {flags} count {count}")
+
+		self.irqfd = os.eventfd(0, 0)
+		print(f"irq eventfd {self.irqfd}")
+		self.bars = None
+
+		glue = _glue()
+		self._read32 = glue.read32
+		self._write32 = glue.write32
+		self.barrier = glue.barrier
+
+	def reset(self):
+		ioctl(self.device, VFIO_DEVICE_RESET, "")
+
+		# the BAR mappings survive a reset, only map them the first time
+		if self.bars is not None:
+			return
+		self.bars = [
+			libc_mmap(None, self.bar0_sz, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_SHARED, self.device, self.bar0_off),
+			libc_mmap(None, self.bar1_sz, mmap.PROT_READ | mmap.PROT_WRITE, mmap.MAP_SHARED, self.device, self.bar1_off),
+		]
+		print(f"bar0 mapped at {self.bars[0]:016X}")
+		print(f"bar1 mapped at {self.bars[1]:016X}")
+
+	def mmioread32(self, reg):
+		bar, off = reg
+		return self._read32(self.bars[bar] + off)
+
+	def mmiowrite32(self, reg, val):
+		bar, off = reg
+		self._write32(self.bars[bar] + off, val)
+
+	def cfgread16(self, off):
+		return struct.unpack("<H", os.pread(self.device, 2, self.cfg_off+off))[0]
+
+	def cfgwrite16(self, off, val):
+		os.pwrite(self.device, struct.pack("<H", val), self.cfg_off+off)
+
+	def cfgread32(self, off):
+		return struct.unpack("<I", os.pread(self.device, 4, self.cfg_off+off))[0]
+
+	def cfgwrite32(self, off, val):
+		os.pwrite(self.device, struct.pack("<I", val), self.cfg_off+off)
+
+	def map_dma(self, mem, iova):
+		mem_addr = addressof(c_char.from_buffer(mem))
+		print(f"memory region at {mem_addr:016X} -> iova {iova:016X}")
+		ioctl(self.group.container, VFIO_IOMMU_MAP_DMA, struct.pack("<IIQQQ", 32, 3, mem_addr, iova, len(mem)))
+
+	def enable_irq(self):
+		ioctl(self.device, VFIO_DEVICE_SET_IRQS, struct.pack("<IIIIII", 24, 0b100100, 1, 0, 1, self.irqfd))
+
+	def close(self):
+		pass
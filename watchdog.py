@@ -0,0 +1,65 @@
+import threading
+import time
+
+
+class Watchdog:
+	"""
+	Looks at the TX rings every `interval` seconds. A pipe that has work
+	outstanding (entries the firmware hasn't consumed, or buffers it hasn't
+	completed) and hasn't moved at all for `stall_timeout` seconds counts as
+	stuck, and the driver gets reset and brought back up. So does a driver
+	that timed out waiting on the device, or whose last recovery failed.
+	"""
+
+	def __init__(self, drv, interval, stall_timeout, log=print):
+		self.drv = drv
+		self.interval = interval
+		self.stall_timeout = stall_timeout
+		self.log = log
+		# pipe -> (head, tail, in flight) last time it changed, and when
+		self.state = {}
+		self.since = {}
+		self.failures = 0
+
+		self.running = True
+		self.wakeup = threading.Event()
+		self.thread = threading.Thread(target=self.watch, daemon=True)
+		self.thread.start()
+
+	def check(self):
+		drv = self.drv
+		now = time.monotonic()
+		for pipe in drv.tx_pipes():
+			state = (drv.get_tr_head(pipe), drv.get_tr_tail(pipe), len(drv.tx_inflight[pipe]))
+			busy = state[0] != state[1] or state[2]
+			if not busy or state != self.state.get(pipe):
+				self.state[pipe] = state
+				self.since[pipe] = now
+			elif now - self.since[pipe] > self.stall_timeout:
+				head, tail, inflight = state
+				return f"pipe {pipe} stuck for {now - self.since[pipe]:.3f} s, head {head} tail {tail}, {inflight} buffers in flight"
+		return None
+
+	def watch(self):
+		while self.running:
+			self.wakeup.wait(self.interval)
+			if not self.running or self.drv.recovering:
+				continue
+			reason = self.drv.needs_recovery or self.check()
+			if reason is None:
+				continue
+			try:
+				self.drv.recover(reason)
+				self.failures = 0
+			except Exception as e:
+				self.failures += 1
+				self.log(f"watchdog: recovery failed ({e!r}), {self.failures} in a row")
+				# back off so a dead device doesn't get reset in a tight loop
+				self.wakeup.wait(min(self.interval * 2**self.failures, 10))
+			self.state.clear()
+			self.since.clear()
+
+	def close(self):
+		self.running = False
+		self.wakeup.set()
+		self.thread.join()